@@ -1,24 +1,32 @@
-from pypylon import genicam
-from pypylon import pylon
 import paho.mqtt.client as mqtt
 import cv2 as cv
 import matplotlib.pyplot as plt
 import numpy as np
 from .imagezmq import ImageSender
 
-from multiprocessing import Pipe, Process, Array
+from multiprocessing import Process, Event, Queue
+import queue
 import time
-import ctypes
 import socket   
 
 
 from .tools import (
     read_config, 
-    SampleImageEventHandler, 
-    detect_marker,
-    ImageSaver,
-    get_calibration_results,
     )
+from .calibration import (
+    CalibrationCollector,
+    Undistorter,
+    calibration_key,
+    calibration_path,
+    save_calibration,
+    load_calibration,
+)
+from .post_processing import make_detector
+from .detect_pool import DetectionPool, Detections
+from ..protocol import pack_detections
+from ..codecs import CODECS, create_codec, select_codec
+from .frame_ring import FrameRing
+from .sources import create_source
 
 class MocapCamera():
     
@@ -29,14 +37,6 @@ class MocapCamera():
         # Read configuration
         self.config = read_config(config_file)
         
-        # TODO - add to config
-        self.img_saver = ImageSaver(
-            tmp_dir="tmp/", 
-            num_imgs=30, 
-            every_n=10, 
-            presistant=self.config["SAVE_CALIB"],
-        )
-        
         # Confgiure MQTT server
        # self.host_name = self.config["MQTT"].get("HOST_NAME", "foo")
        # self.client = mqtt.Client(
@@ -47,50 +47,23 @@ class MocapCamera():
         hostname=socket.gethostname()   
         self.IPAddr=socket.gethostbyname(hostname)   
         # self.init_mqtt()
-        # Create a pipe for image passing
-        self.camera_pipe = Pipe()
+        # Set to stop all processes reading from the frame ring
+        self.stop_event = Event()
 
         # Parse camera configuration
-        fps = self.config["CAMERA"].get("FPS", 60)
-        exposure = self.config["CAMERA"].get("EXPOSURE", 10000.0)
-        hard_trigg =  self.config["CAMERA"].get("HARD_TRIGG", False)
+        buffer_slots = self.config["CAMERA"].get("BUFFER_SLOTS", 8)
         
-        # Connect camera
-        self.camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice()) 
-        
-        self.camera.Open() 
-        # Set fps
-        self.camera.AcquisitionFrameRateEnable.SetValue(True)
-        self.camera.AcquisitionFrameRate.SetValue(fps)
-        # Set exposure time
-        self.camera.ExposureTime.SetValue(exposure)
-        # Set pixel format to mono
-        self.camera.PixelFormat.SetValue("Mono8")
-        self.WIDTH = self.camera.Width.GetValue()
-        self.HEIGHT = self.camera.Height.GetValue()
+        # Connect camera, or whatever source is configured instead of it
+        self.source = create_source(self.config["CAMERA"])
+        self.WIDTH, self.HEIGHT = self.source.open()
 
-        self.camera.Close()
+        # Intrinsics from an earlier run on this camera, if still valid
+        self.calibration = self.load_calibration()
          
-        ARR_SIZE = self.WIDTH * self.HEIGHT
-        
-        self.shared_arr = Array(
-            ctypes.c_ubyte, 
-            ARR_SIZE,
-        )
-        
-        if hard_trigg: 
-            # TODO - add as a hardware trigger
-            self.camera.RegisterConfiguration(
-                pylon.SoftwareTriggerConfiguration(), 
-                pylon.RegistrationMode_ReplaceAll,
-                pylon.Cleanup_Delete,
-            )
-        
-        self.camera.RegisterImageEventHandler(
-            # SampleImageEventHandler(self.camera_pipe[0]),
-            SampleImageEventHandler(self.camera_pipe[0], self.shared_arr), 
-            pylon.RegistrationMode_Append,
-            pylon.Cleanup_Delete,
+        self.frame_ring = FrameRing(
+            self.WIDTH, 
+            self.HEIGHT, 
+            buffer_slots,
         )
        
         # Initialize processes
@@ -98,162 +71,280 @@ class MocapCamera():
         
     def initialize_processes(self):
         """ Initialize processes and communitaion for processing pipe line """
-        detect = Process(
-            target=self._detect, 
-            args=(self.camera_pipe[1], self.shared_arr)
-        )
+        # Consumers currently running, name -> process
+        self.processes = {}
+        self.consumers = {}
+        # Collected calibration views, back from the calibration process
+        self.calib_queue = Queue()
         
-        calibration = Process(
-            target=self._calibraion,
-            args=(self.camera_pipe[1], self.shared_arr)
-        )
+        rates = self.config.get("CONSUMERS", {})
+        for name, target in (
+            ("detect", self._detect),
+            ("calibration", self._calibraion),
+            ("send_images", self._send_image),
+        ):
+            self.register_consumer(
+                name, 
+                target, 
+                rates.get(name, {}).get("MAX_FPS"),
+                # Detection wants the newest frame after falling behind
+                catch_up=name == "detect",
+            )
 
-        send_images  = Process(
-            target=self._send_image,
-            args=(self.camera_pipe[1], self.shared_arr)
-        )
+    def register_consumer(self, name, target, max_fps=None, catch_up=False):
+        """ 
+        Register a processing stage fed from the frame ring. The target is
+        run in its own process as target(reader, stop_event) and should
+        return once stop_event is set. Every consumer has its own cursor, so all
+        of them see the same frames, at most max_fps of them per second.
+        With catch_up a consumer that fell behind skips to the newest frame
+        instead of the oldest one still in the ring.
+        """
+        self.consumers[name] = (target, max_fps, catch_up)
         
-        self.processes = {
-            "detect": [detect],
-            "calibration": [calibration],
-            "send_images": [send_images],
-        }
+    def start(self, *names):
+        """ Start the given consumers next to the ones already running """
+        for name in names:
+            if name in self.processes and self.processes[name].is_alive():
+                continue
+            target, max_fps, catch_up = self.consumers[name]
+            proc = Process(
+                target=target,
+                args=(
+                    self.frame_ring.reader(max_fps=max_fps, catch_up=catch_up),
+                    self.stop_event,
+                ),
+            )
+            proc.start()
+            self.processes[name] = proc
+            
+        if not self.source.is_grabbing():
+            self.source.start(self.frame_ring)
      
-    def _send_image(self, pipe_in, shared_memory):
+    def _send_image(self, reader, stop_event):
         """ Send images to the server to be saved """
-        shared_np = np.frombuffer(
-            shared_memory.get_obj(), 
-            dtype=np.uint8,
-        )
+        server_config = self.config["SERVER"]
+        port = server_config.get("IMG_PORT", 5555)
         sender = ImageSender(
-                connect_to=f"tcp://*:5555",
+                connect_to=f"tcp://*:{port}",
                 REQ_REP=False
         )
+        codec_name = server_config.get("CODEC", "jpeg")
+        codec_params = server_config.get("CODEC_PARAMS", {})
 
-        while True:
-            item = pipe_in.recv()
-            if item is None:
-                    break
-            status = item
-            with shared_memory.get_lock():
-                frame = np.copy(shared_np)
+        def make_codec(name):
+            params = codec_params.get(name) or {}
+            return create_codec(name, **{k.lower(): v for k, v in params.items()})
+
+        # With auto the codec is chosen on the first frame
+        codec = None if codec_name == "auto" else make_codec(codec_name)
+
+        while not stop_event.is_set():
+            frame = reader.read(timeout=0.1)
+            if frame is None:
+                continue
 
-            frame = frame.reshape((self.HEIGHT, self.WIDTH))
-            print(f"Sending images: {frame.shape}")
+            if codec is None:
+                codec = select_codec(
+                    [frame.image],
+                    [make_codec(name) for name in CODECS
+                     if name in server_config.get("CODEC_CANDIDATES", CODECS)],
+                    server_config.get("CODEC_BUDGET_MS", 20) * 1e-3,
+                )
+                print(f"Sending images with the {codec.name} codec")
+
+            print(f"Sending images: {frame.image.shape}")
+            # Encode straight from the ring slot
+            payload, meta = codec.encode(frame.image)
+            if not reader.release(frame):
+                # Overwritten while encoding, don't send a torn frame
+                continue
             # Send zeroM
-            ret_code, frame = cv.imencode(
-                ".jpg", frame, [int(cv.IMWRITE_JPEG_QUALITY), 95])
-            sender.send_jpg_pubsub(
+            sender.send_frame(
                 f"{self.IPAddr}", 
-                frame
+                payload,
+                codec=codec.name,
+                seq=frame.seq,
+                cam_ts=frame.cam_ts,
+                grab_ts=frame.grab_ts,
+                **meta,
             )
 
-    def _detect(self, pipe_in, shared_memory):
+        # Don't wait for frames nobody is going to take
+        sender.close(linger=0)
+        print("Sending stats:", reader.stats())
+
+    def _detect(self, reader, stop_event):
         """ Thread used for marker detection """
+        detect_config = self.config.get("DETECT", {})
+        workers = detect_config.get("WORKERS", 1)
+        show = detect_config.get("SHOW", True)
+        if workers > 1:
+            # The workers read the ring themselves, at the rate of this consumer
+            pool = DetectionPool(
+                reader.ring,
+                self.config["POST_PROC"],
+                stop_event,
+                workers,
+                detect_config.get("REORDER", 8),
+                1.0 / reader.min_period if reader.min_period else None,
+            )
+            results = pool.results()
+        else:
+            results = self._detect_frames(reader, stop_event, show)
 
-        shared_np = np.frombuffer(
-            shared_memory.get_obj(), 
-            dtype=np.uint8,
+        # Normalized coordinates for triangulation, once intrinsics exist
+        undistort = None
+        if self.calibration is not None and detect_config.get("UNDISTORT", True):
+            undistort = Undistorter(self.calibration)
+
+        port = self.config["SERVER"].get("DET_PORT", 5556)
+        sender = ImageSender(
+                connect_to=f"tcp://*:{port}",
+                REQ_REP=False
         )
-        
-        while True:
-            item = pipe_in.recv()
-            if item is None:
-                break
-            cnt, ts = item
-            with shared_memory.get_lock():
-                frame = np.copy(shared_np)
-                frame = frame.reshape((self.HEIGHT, self.WIDTH))
+        for item in results:
+            if show and workers > 1:
+                # Drawn here, the frame is shown if it is still in the ring
+                frame = reader.ring.view(item.seq)
+                if frame is not None:
+                    self._show(frame, item.markers)
+            if undistort is not None:
+                item = item._replace(markers=undistort(item.markers))
+            print("Delay: ", f"{(time.time_ns() - item.grab_ts)*1e-9:.4f} sec")
+            # A few tens of bytes per frame instead of an image
+            sender.send_jpg_pubsub(
+                f"{self.IPAddr}",
+                pack_detections(*item),
+            )
+        sender.close(linger=0)
+
+        if workers > 1:
+            print("Detection stats:", pool.stats())
+        else:
+            print("Detection stats:", reader.stats())
+
+    def _detect_frames(self, reader, stop_event, show=False):
+        """ Detect markers on the frames of a single reader """
+        detector = make_detector(self.config["POST_PROC"])
+        while not stop_event.is_set():
+            frame = reader.read(timeout=0.1)
+            if frame is None:
+                continue
 
             # Post processing as in old project
-            objs = detect_marker(frame, self.config["POST_PROC"]) 
-            print("Delay: ", f"{(time.perf_counter_ns() - ts)*1e-9:.4f} sec")
-            for _ ,x, y, r in objs:
-                img = cv.circle(frame, (int(x), int(y)), int(r), (0,0,255), 5)
-            cv.putText(frame, str(cnt), (50, 50), cv.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 2, cv.LINE_AA)
-            cv.imshow("Frame", frame)
-            cv.waitKey(1)
-            # TODO - send detections to processor
+            objs = detector(frame.image)
+            if not reader.release(frame):
+                continue
+            if show:
+                self._show(frame, objs)
+
+            yield Detections(frame.seq, frame.cam_ts, frame.grab_ts, objs)
+
+    def _show(self, frame, objs):
+        """ Show a frame with its markers circled """
+        # Draw on a copy, the frame is shared with other consumers
+        img = np.copy(frame.image)
+        for x, y, r in zip(objs["x"], objs["y"], objs["r"]):
+            img = cv.circle(img, (int(x), int(y)), int(r), (0,0,255), 5)
+        cv.putText(img, str(frame.seq), (50, 50), cv.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 2, cv.LINE_AA)
+        cv.imshow("Frame", img)
+        cv.waitKey(1)
     
-    def _calibraion(self, pipe_in, shared_memory):
-        """ Thread used for marker detection """
-        
-        shared_np = np.frombuffer(
-            shared_memory.get_obj(), 
-            dtype=np.uint8,
+    def _calibraion(self, reader, stop_event):
+        """ Collect chessboard views until there are enough of them """
+        collector = CalibrationCollector(
+            self.config["CALIB"],
+            # Keep the accepted images for offline calibration
+            save_dir="tmp/" if self.config["SAVE_CALIB"] else None,
         )
-        
-        while True:
-            #item = pipe_in.recv()
-            #if item is None:
-            #    break
-            #cnt, ts = item
-            with shared_memory.get_lock():
-                frame = np.copy(shared_np)
-                frame = frame.reshape((self.HEIGHT, self.WIDTH))
+        while not stop_event.is_set() and not collector.done():
+            frame = reader.read(timeout=0.1)
+            if frame is None:
+                continue
 
-            res = self.img_saver.save_image(frame)            
-            if res:
-                print("exiting ..")
-                # End after images has been colected
-                break
+            # Copy out of the ring, the search is slow next to the copy
+            # and would have the slot overwritten under it
+            image = frame.image.copy()
+            if not reader.release(frame):
+                # Overwritten while copying
+                continue
+            if collector.add(image):
+                print(f"Calibration view {len(collector.views)}/{collector.num_views}")
+
+        # Corners only, a few kB
+        self.calib_queue.put(collector)
     
     def start_sending(self):
-        self.running = "send_images"
-        for proc in self.processes["send_images"]:
-            proc.start()
-            
-        self.camera.StartGrabbing(
-            # pylon.GrabStrategy_OneByOne, 
-            pylon.GrabStrategy_LatestImageOnly,
-            pylon.GrabLoop_ProvidedByInstantCamera,
-        )
-            
-        
-    def run_calibration(self):
-        self.running = "calibration"
+        self.start("send_images")
         
-        for proc in self.processes["calibration"]:
-            proc.start() 
-            
-        self.camera.StartGrabbing(
-            # pylon.GrabStrategy_OneByOne, 
-            pylon.GrabStrategy_LatestImageOnly,
-            pylon.GrabLoop_ProvidedByInstantCamera,
+    def calibration_file(self):
+        """ Cache file of the camera and the key its contents have to match """
+        calib_config = self.config["CALIB"]
+        serial = self.source.serial or "unknown"
+        image_size = (self.WIDTH, self.HEIGHT)
+        return (
+            calibration_path(
+                calib_config.get("CACHE_DIR", "calib/"), serial, image_size),
+            calibration_key(serial, image_size, calib_config),
         )
+
+    def load_calibration(self):
+        path, key = self.calibration_file()
+        calibration = load_calibration(path, key)
+        if calibration is not None:
+            print(f"Loaded calibration from {path}, rms {calibration.rms:.3f}")
+        return calibration
+
+    def run_calibration(self, force=False):
+        """ 
+        Collect views until CALIB.NUM_VIEWS are accepted (or stop is
+        called) and calibrate on them. The Calibration is cached per
+        camera, a valid cached one is returned unless force is set.
+        """
+        if self.calibration is not None and not force:
+            return self.calibration
+
+        self.start("calibration")
             
-        # Wait for photos
-        for proc in self.processes["calibration"]:
-            proc.join()
-        self.camera.StopGrabbing()  
+        # Wait for the views, taken before the join so the queue is drained
+        proc = self.processes["calibration"]
+        while True:
+            try:
+                collector = self.calib_queue.get(timeout=0.5)
+                break
+            except queue.Empty:
+                if not proc.is_alive():
+                    raise RuntimeError("Calibration process ended without results")
+        self.processes.pop("calibration").join()
+        if not self.processes:
+            self.source.stop()  
         
         # Perform calibration
-        calib_res = get_calibration_results(
-            self.img_saver.tmp_dir,
-            self.config["CALIB"],
-        )
+        self.calibration = collector.calibrate()
+        save_calibration(*self.calibration_file(), self.calibration)
         
         # TODO - send calibration results to the MQTT server
         
-        return calib_res
+        return self.calibration
         
     def start_detect(self):
-        self.running = "detect"
-        for proc in self.processes["detect"]:
-            proc.start()
-            
-        self.camera.StartGrabbing(
-            # pylon.GrabStrategy_OneByOne, 
-            pylon.GrabStrategy_LatestImageOnly,
-            pylon.GrabLoop_ProvidedByInstantCamera,
-        )
-            
+        self.start("detect")
      
-    def stop(self):      
-        self.camera.StopGrabbing()
+    def stop(self, timeout=5.0):
+        """
+        Stop grabbing and the consumers, the ones still running timeout
+        seconds after the stop event are terminated
+        """
+        self.source.stop()
         
-        # Send poison pill
-        # self.camera_pipe[0].send(None)
-        # TODO - kill all child processes
-        for proc in self.processes[self.running]:
-            proc.join()
+        # Processes check the event between frames
+        self.stop_event.set()
+        for name, proc in self.processes.items():
+            proc.join(timeout)
+            if proc.is_alive():
+                print(f"Consumer {name} ignored the stop event, terminating it")
+                proc.terminate()
+                proc.join()
+        self.processes = {}
+        self.stop_event.clear()
@@ -0,0 +1,161 @@
+"""
+Throughput of the camera pipeline stages, measured on frames from a
+synthetic or replay source so no camera is needed.
+
+    python -m mocap.camera.benchmark configs/synthetic_cam.yaml
+"""
+import argparse
+import time
+
+import numpy as np
+import cv2 as cv
+
+from .tools import read_config, detect_marker
+from .frame_ring import FrameRing
+from .sources import create_source
+from .calibration import Calibration, Undistorter
+from ..codecs import CODECS, create_codec, benchmark_codecs
+from .post_processing import (
+    WindowedDetector, 
+    PyramidDetector, 
+    StripedDetector,
+)
+
+
+def collect_frames(source, num_frames):
+    """ Take the first num_frames frames out of a threaded source """
+    source.open()
+    frames = []
+    for img, _ in source.frames():
+        frames.append(img.copy())
+        if len(frames) >= num_frames:
+            break
+    return frames
+
+def time_stage(stage, frames, repeat=1):
+    """ Run stage on every frame, returns per-frame times in seconds """
+    times = []
+    for _ in range(repeat):
+        for frame in frames:
+            start = time.perf_counter()
+            stage(frame)
+            times.append(time.perf_counter() - start)
+    return np.array(times)
+
+def build_stages(config, frames):
+    """ Stage name -> callable taking a single frame """
+    height, width = frames[0].shape[:2]
+    ring = FrameRing(width, height, config["CAMERA"].get("BUFFER_SLOTS", 8))
+    reader = ring.reader()
+    post_proc = config["POST_PROC"]
+    close_merge = dict(post_proc, MERGE="close")
+    stats_merge = dict(post_proc, MERGE="stats")
+
+    def ring_round_trip(frame):
+        ring.publish(frame)
+        reader.release(reader.poll())
+
+    # Made up intrinsics, the cost doesn't depend on the values
+    undistort = Undistorter(Calibration(
+        0.0,
+        np.array([[width, 0, width / 2], [0, width, height / 2], [0, 0, 1]]),
+        np.array([-0.2, 0.05, 0, 0, 0]),
+        (width, height),
+    ))
+
+    stages = {
+        "ring_publish_read": ring_round_trip,
+        "detect_marker": lambda frame: detect_marker(frame, post_proc),
+        "detect_close_merge": lambda frame: detect_marker(frame, close_merge),
+        "detect_stats_merge": lambda frame: detect_marker(frame, stats_merge),
+        "detect_tracking": WindowedDetector(post_proc),
+        "detect_pyramid": PyramidDetector(post_proc),
+        "detect_striped": StripedDetector(post_proc),
+        "detect_undistort": lambda frame: undistort(detect_marker(frame, post_proc)),
+        "jpeg_q95": lambda frame: cv.imencode(
+            ".jpg", frame, [int(cv.IMWRITE_JPEG_QUALITY), 95]),
+    }
+    return stages
+
+def compare_detections(frames, config, reference, other):
+    """ 
+    Accuracy of the other detection config against the reference one,
+    markers are matched to the nearest reference marker within its radius
+    """
+    matched, missed, extra, offsets = 0, 0, 0, []
+    for frame in frames:
+        ref = detect_marker(frame, dict(config, **reference))
+        objs = detect_marker(frame, dict(config, **other))
+        if not len(ref) or not len(objs):
+            missed += len(ref)
+            extra += len(objs)
+            continue
+        dist = np.hypot(
+            ref["x"][:, None] - objs["x"][None, :],
+            ref["y"][:, None] - objs["y"][None, :],
+        )
+        nearest = dist.argmin(axis=1)
+        hit = dist[np.arange(len(ref)), nearest] <= ref["r"]
+        matched += np.count_nonzero(hit)
+        missed += np.count_nonzero(~hit)
+        extra += len(objs) - len(np.unique(nearest[hit]))
+        offsets.extend(dist[np.arange(len(ref)), nearest][hit])
+
+    offset = np.mean(offsets) if offsets else float("nan")
+    print(
+        f"{other} vs {reference}: matched {matched} missed {missed}"
+        f" extra {extra} mean centroid offset {offset:.3f} px"
+    )
+
+def report_codecs(frames):
+    """ Encode/decode time and size of every registered codec """
+    results = benchmark_codecs(frames, [create_codec(name) for name in CODECS])
+    raw_size = frames[0].nbytes
+    for name, (encode_t, decode_t, size) in results.items():
+        print(
+            f"codec {name:<8} encode {encode_t*1e3:8.3f} ms"
+            f"  decode {decode_t*1e3:8.3f} ms"
+            f"  {size/1e3:9.1f} kB/frame ({size/raw_size:6.1%} of raw)"
+        )
+
+def report(name, times):
+    median = np.median(times)
+    print(
+        f"{name:<24} median {median*1e3:8.3f} ms"
+        f"  p95 {np.percentile(times, 95)*1e3:8.3f} ms"
+        f"  max rate {1/median:9.1f} fps"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("config", help="camera config with a synthetic/replay source")
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stages", nargs="*", help="subset of stages to run")
+    parser.add_argument("--codecs", action="store_true", help="benchmark the frame codecs")
+    args = parser.parse_args()
+
+    config = read_config(args.config)
+    source = create_source(config["CAMERA"])
+
+    start = time.perf_counter()
+    frames = collect_frames(source, args.frames)
+    report("source", np.full(len(frames), (time.perf_counter() - start) / len(frames)))
+
+    stages = build_stages(config, frames)
+    for name in args.stages or stages:
+        report(name, time_stage(stages[name], frames, args.repeat))
+
+    compare_detections(
+        frames, 
+        config["POST_PROC"], 
+        dict(MERGE="close"), 
+        dict(MERGE="stats"),
+    )
+
+    if args.codecs:
+        report_codecs(frames)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+from collections import namedtuple
+from pathlib import Path
+import hashlib
+import json
+import os
+
+import numpy as np
+import cv2 as cv
+
+from .tools import (
+    find_chessboard,
+    chessboard_points,
+    select_views,
+    coverage_stats,
+    MARKER_DTYPE,
+    UNDISTORTED_DTYPE,
+)
+
+# Intrinsics of a camera, what is kept of the cv.calibrateCamera result
+Calibration = namedtuple(
+    "Calibration", ["rms", "camera_matrix", "dist_coeffs", "image_size"])
+
+# CALIB keys the result depends on, the rest only changes how it is computed
+CALIB_KEYS = ("ROWS", "COLS", "NUM_VIEWS", "MIN_MOVE", "MAX_VIEWS")
+
+
+class CalibrationCollector():
+    """
+    Collects chessboard views for calibration while the frames arrive.
+
+    Only the refined corners of accepted views are kept, not the images.
+    A view is accepted when the board is found and its corners moved on
+    average at least MIN_MOVE px from every view accepted so far, so a
+    board held still doesn't fill the set with copies of one view. The
+    collector is done once NUM_VIEWS views are accepted, calibration runs
+    on the MAX_VIEWS most diverse of them.
+    """
+    def __init__(self, config, save_dir=None):
+        self.rows, self.cols = config["ROWS"], config["COLS"]
+        self.num_views = config.get("NUM_VIEWS", 30)
+        self.min_move = config.get("MIN_MOVE", 20)
+        self.max_views = config.get("MAX_VIEWS", 20)
+        # Width the board is searched at, null for the full frame
+        self.search_width = config.get("SEARCH_WIDTH", 640)
+        # Accepted images are written here too, for offline calibration
+        self.save_dir = None if save_dir is None else Path(save_dir)
+        if self.save_dir is not None:
+            self.save_dir.mkdir(parents=True, exist_ok=True)
+        self.image_size = None
+        self.views = []
+        self.frames = 0
+        self.found = 0
+
+    def add(self, img):
+        """ Look for the board on a frame, returns whether the view was kept """
+        self.frames += 1
+        self.image_size = img.shape[1], img.shape[0]
+        corners = find_chessboard(img, self.rows, self.cols, self.search_width)
+        if corners is None:
+            return False
+        self.found += 1
+        if not self.is_new(corners):
+            return False
+
+        if self.save_dir is not None:
+            cv.imwrite(str(self.save_dir / f"frame_{len(self.views):03}.bmp"), img)
+        self.views.append(corners)
+        return True
+
+    def is_new(self, corners):
+        if not self.views:
+            return True
+        # Mean corner displacement against every accepted view
+        views = np.stack(self.views).reshape(len(self.views), -1, 2)
+        moves = np.linalg.norm(
+            views - corners.reshape(1, -1, 2), axis=2).mean(axis=1)
+        return moves.min() >= self.min_move
+
+    def done(self):
+        return len(self.views) >= self.num_views
+
+    def coverage(self, views=None):
+        """ coverage_stats of the given views, all collected ones by default """
+        views = self.views if views is None else views
+        return coverage_stats(views, self.rows, self.cols, self.image_size)
+
+    def calibrate(self):
+        """ cv.calibrateCamera on the collected views, as a Calibration """
+        if not self.views:
+            raise RuntimeError(
+                f"No chessboard views collected ({self.frames} frames seen)")
+        objp = chessboard_points(self.rows, self.cols)
+        keep = select_views(
+            self.views, self.rows, self.cols, self.image_size, self.max_views)
+        views = [self.views[i] for i in keep]
+        print(
+            f"Calibrating on {len(views)} of {len(self.views)} views, board "
+            f"found on {self.found} of {self.frames} frames"
+        )
+        print("Calibration views:", self.coverage(views))
+        rms, camera_matrix, dist_coeffs, _, _ = cv.calibrateCamera(
+            [objp] * len(views),
+            views,
+            self.image_size,
+            None,
+            None,
+        )
+        return Calibration(rms, camera_matrix, dist_coeffs, self.image_size)
+
+
+def calibration_key(serial, image_size, config):
+    """ Hash of the camera serial, resolution and calibration settings """
+    settings = {name: config.get(name) for name in CALIB_KEYS}
+    text = json.dumps([serial, list(image_size), settings], sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def calibration_path(cache_dir, serial, image_size):
+    return Path(cache_dir) / f"{serial}_{image_size[0]}x{image_size[1]}.npz"
+
+def save_calibration(path, key, calibration):
+    """ Store a Calibration under key, replaces the file atomically """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp.npz")
+    np.savez(
+        tmp_path,
+        key=key,
+        rms=calibration.rms,
+        camera_matrix=calibration.camera_matrix,
+        dist_coeffs=calibration.dist_coeffs,
+        image_size=calibration.image_size,
+    )
+    os.replace(tmp_path, path)
+
+def load_calibration(path, key):
+    """ Calibration stored in path, None if there is none for this key """
+    try:
+        with np.load(path) as data:
+            if str(data["key"]) != key:
+                # Other camera, resolution or settings, calibrate again
+                return None
+            return Calibration(
+                float(data["rms"]),
+                data["camera_matrix"],
+                data["dist_coeffs"],
+                tuple(data["image_size"].tolist()),
+            )
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class Undistorter():
+    """
+    Lens correction of the marker centroids of a frame, the cost grows
+    with the number of markers, not with the frame size. Markers get the
+    normalized image coordinates nx, ny (x/z, y/z in the camera frame)
+    next to the pixel ones.
+    """
+    def __init__(self, calibration):
+        self.camera_matrix = np.asarray(calibration.camera_matrix, dtype=np.float64)
+        self.dist_coeffs = np.asarray(calibration.dist_coeffs, dtype=np.float64)
+
+    def normalize(self, points):
+        """ (N, 2) distorted pixel coordinates -> (N, 2) normalized ones """
+        if not len(points):
+            return np.empty((0, 2))
+        return cv.undistortPoints(
+            np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 1, 2),
+            self.camera_matrix,
+            self.dist_coeffs,
+        ).reshape(-1, 2)
+
+    def __call__(self, markers):
+        """ MARKER_DTYPE array -> UNDISTORTED_DTYPE array """
+        out = np.empty(len(markers), dtype=UNDISTORTED_DTYPE)
+        for name in MARKER_DTYPE.names:
+            out[name] = markers[name]
+        normalized = self.normalize(np.column_stack([markers["x"], markers["y"]]))
+        out["nx"], out["ny"] = normalized[:, 0], normalized[:, 1]
+        return out
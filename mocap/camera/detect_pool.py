@@ -0,0 +1,182 @@
+from multiprocessing import Process, Queue
+from collections import namedtuple
+import queue
+
+from .post_processing import make_detector
+
+# Markers found on frame seq
+Detections = namedtuple("Detections", ["seq", "cam_ts", "grab_ts", "markers"])
+
+# Placeholder of a sequence number no result is coming for
+_SKIPPED = object()
+
+
+class ReorderBuffer():
+    """
+    Puts results arriving out of order back in sequence order, starting at
+    first_seq.
+
+    Sequence numbers marked with skip() are passed over without a result
+    (frames a worker didn't take). At most depth results wait for a missing
+    one, after that the missing sequence numbers are given up on and
+    counted as dropped. Results older than what was already emitted are
+    dropped as well.
+    """
+    def __init__(self, depth, first_seq=None):
+        self.depth = depth
+        self.next_seq = first_seq
+        self.pending = {}
+        self.waiting = 0
+        self.processed = 0
+        self.skipped = 0
+        self.dropped = 0
+
+    def push(self, seq, item):
+        """ Add a result, returns the results that are now in order """
+        if self.next_seq is None:
+            self.next_seq = seq
+        if seq < self.next_seq:
+            self.dropped += 1
+            return []
+        self.pending[seq] = item
+        self.waiting += 1
+
+        if self.waiting > self.depth:
+            # Stop waiting for the oldest missing results
+            first = min(self.pending)
+            self.dropped += first - self.next_seq
+            self.next_seq = first
+
+        return self._pop_ready()
+
+    def skip(self, seqs):
+        """ Pass over seqs, returns the results that are now in order """
+        for seq in seqs:
+            if self.next_seq is None or seq >= self.next_seq:
+                self.pending[seq] = _SKIPPED
+        return self._pop_ready()
+
+    def _pop_ready(self):
+        ready = []
+        while self.next_seq in self.pending:
+            item = self.pending.pop(self.next_seq)
+            if item is _SKIPPED:
+                self.skipped += 1
+            else:
+                self.waiting -= 1
+                ready.append(item)
+            self.next_seq += 1
+        self.processed += len(ready)
+        return ready
+
+    def flush(self):
+        """ Everything still waiting, in order, gaps counted as dropped """
+        ready = []
+        while self.pending:
+            first = min(self.pending)
+            self.dropped += first - self.next_seq
+            self.next_seq = first
+            ready.extend(self._pop_ready())
+        return ready
+
+
+class DetectionPool():
+    """
+    K detection processes fed round-robin from the frame ring, worker k
+    takes the frames with seq % K == k straight from the ring (no copy),
+    results are returned in frame order.
+
+    With max_fps the workers share the rate, each one takes max_fps / K
+    frames per second. Workers report the frames of theirs they passed
+    over (rate limit, fallen behind, overwritten), so the results after
+    them don't wait for those.
+    """
+    def __init__(self, frame_ring, config, stop_event, workers=2, reorder=8, max_fps=None):
+        self.frame_ring = frame_ring
+        self.config = config
+        self.stop_event = stop_event
+        self.results_queue = Queue()
+        readers = [
+            frame_ring.reader(
+                max_fps=max_fps / workers if max_fps else None,
+                stride=workers,
+                offset=k,
+                catch_up=True,
+            )
+            for k in range(workers)
+        ]
+        # The first frame any of the workers is going to take
+        self.reorder = ReorderBuffer(
+            reorder, min(reader.next_seq(reader.cursor + 1) for reader in readers))
+        self.processes = [
+            Process(target=self._worker, args=(reader,))
+            for reader in readers
+        ]
+
+    def _worker(self, reader):
+        detector = make_detector(self.config)
+        # Next frame of this worker not yet taken or reported as skipped
+        expected = reader.next_seq(reader.cursor + 1)
+        while not self.stop_event.is_set():
+            frame = reader.read(timeout=0.1)
+            if frame is None:
+                continue
+
+            skipped = list(range(expected, frame.seq, reader.stride))
+            expected = frame.seq + reader.stride
+            markers = detector(frame.image)
+            if not reader.release(frame):
+                self.results_queue.put((skipped + [frame.seq], None))
+                continue
+            self.results_queue.put((
+                skipped,
+                Detections(frame.seq, frame.cam_ts, frame.grab_ts, markers),
+            ))
+
+    def start(self):
+        for proc in self.processes:
+            proc.start()
+
+    def _order(self, message):
+        skipped, item = message
+        ready = self.reorder.skip(skipped)
+        if item is not None:
+            ready += self.reorder.push(item.seq, item)
+        return ready
+
+    def results(self):
+        """ Generator of Detections in frame order, ends once stopped """
+        self.start()
+        while not self.stop_event.is_set():
+            try:
+                message = self.results_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            yield from self._order(message)
+
+        # Workers can't exit before their queued results are taken
+        while any(proc.is_alive() for proc in self.processes):
+            try:
+                message = self.results_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            yield from self._order(message)
+        for proc in self.processes:
+            proc.join()
+        while True:
+            try:
+                message = self.results_queue.get(timeout=0.1)
+            except queue.Empty:
+                break
+            yield from self._order(message)
+        yield from self.reorder.flush()
+
+    def stats(self):
+        return dict(
+            processed=self.reorder.processed,
+            # Frames the workers passed over, rate limit or fallen behind
+            passed=self.reorder.skipped,
+            # Frames whose result didn't come in within the reorder window
+            dropped=self.reorder.dropped,
+            skipped=self.frame_ring.skipped,
+        )
@@ -0,0 +1,262 @@
+from multiprocessing import RawArray, Lock
+from collections import namedtuple
+import ctypes
+import time
+
+import numpy as np
+
+# Slot header layout, one row of int64 words per slot
+SEQ, CAM_TS, GRAB_TS, WIDTH, HEIGHT = range(5)
+HEADER_LEN = 8
+
+# Control block layout
+HEAD, SKIPPED = range(2)
+CONTROL_LEN = 4
+
+# Marks a slot that is being written by the grab thread. The check only
+# holds if a reader seeing a slot's sequence number also sees the pixels and
+# header written before it. RawArray stores are plain memory writes that a
+# weakly ordered CPU (the ARM of the Jetson) can make visible out of order,
+# so the sequence numbers and the head are only read and written holding
+# the ring lock: semaphore operations synchronize memory (POSIX), they are
+# the barriers between the pixel data and its sequence number.
+WRITING = -1
+
+Frame = namedtuple("Frame", ["seq", "cam_ts", "grab_ts", "image"])
+
+
+class FrameRing():
+    """
+    N-slot ring of frames in shared memory.
+
+    There is a single writer (the grab thread) and any number of readers,
+    each one in its own process with its own cursor. The frames are never
+    locked: the writer marks a slot as WRITING, fills it, stamps the
+    sequence number and only then moves the head, readers check the slot
+    sequence number to find out if a frame was overwritten under them. Only
+    the sequence numbers go through the lock, for the memory ordering (see
+    WRITING).
+    """
+    def __init__(self, width, height, num_slots=8):
+        if num_slots < 2:
+            raise ValueError("Frame ring needs at least 2 slots")
+        self.width = width
+        self.height = height
+        self.num_slots = num_slots
+        self.slot_size = width * height
+
+        self._data = RawArray(ctypes.c_ubyte, num_slots * self.slot_size)
+        self._header = RawArray(ctypes.c_int64, num_slots * HEADER_LEN)
+        self._control = RawArray(ctypes.c_int64, CONTROL_LEN)
+        self._lock = Lock()
+        self._attach()
+        self.header[:, SEQ] = WRITING
+
+    def _attach(self):
+        """ Create numpy views of the shared buffers """
+        self.data = np.frombuffer(self._data, dtype=np.uint8).reshape(
+            (self.num_slots, self.slot_size))
+        self.header = np.frombuffer(self._header, dtype=np.int64).reshape(
+            (self.num_slots, HEADER_LEN))
+        self.control = np.frombuffer(self._control, dtype=np.int64)
+
+    def __getstate__(self):
+        # Numpy views can't be pickled, shared buffers can (when spawning)
+        state = self.__dict__.copy()
+        for name in ("data", "header", "control"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    @property
+    def head(self):
+        """ Sequence number of the last published frame, 0 if none """
+        with self._lock:
+            return int(self.control[HEAD])
+
+    @property
+    def skipped(self):
+        """ Frames skipped by the camera before they reached the ring """
+        return int(self.control[SKIPPED])
+
+    def publish(self, img, cam_ts=0, grab_ts=None):
+        """ Copy a frame into the next slot, returns its sequence number """
+        height, width = img.shape[:2]
+        if width * height > self.slot_size:
+            raise ValueError(
+                f"Frame {width}x{height} does not fit in the ring slot")
+        if grab_ts is None:
+            grab_ts = time.time_ns()
+
+        seq = self.head + 1
+        hdr = self.header[seq % self.num_slots]
+        with self._lock:
+            hdr[SEQ] = WRITING
+        self.data[seq % self.num_slots, :width * height] = img.reshape(-1)
+        hdr[CAM_TS] = cam_ts
+        hdr[GRAB_TS] = grab_ts
+        hdr[WIDTH] = width
+        hdr[HEIGHT] = height
+        with self._lock:
+            hdr[SEQ] = seq
+            self.control[HEAD] = seq
+
+        return seq
+
+    def count_skipped(self, n):
+        self.control[SKIPPED] += n
+
+    def view(self, seq):
+        """ Zero-copy view of frame `seq`, None if it is no longer in the ring """
+        slot = seq % self.num_slots
+        hdr = self.header[slot]
+        if self._slot_seq(slot) != seq:
+            return None
+        width, height = int(hdr[WIDTH]), int(hdr[HEIGHT])
+        frame = Frame(
+            seq,
+            int(hdr[CAM_TS]),
+            int(hdr[GRAB_TS]),
+            self.data[slot, :width * height].reshape((height, width)),
+        )
+        # The writer could have started on the slot while reading the header
+        if self._slot_seq(slot) != seq:
+            return None
+        return frame
+
+    def _slot_seq(self, slot):
+        with self._lock:
+            return int(self.header[slot, SEQ])
+
+    def valid(self, frame):
+        """
+        Check that a view has not been overwritten since it was taken, call
+        it after the last access to the pixels (copy, encode, detect)
+        """
+        return self._slot_seq(frame.seq % self.num_slots) == frame.seq
+
+    def reader(self, **kwargs):
+        return FrameReader(self, **kwargs)
+
+
+class FrameReader():
+    """
+    Consumer cursor over a FrameRing.
+
+    Every reader has its own cursor, so each consumer sees every frame
+    independently of the others. Frames older than the ring can hold are
+    counted as dropped, a reader that falls behind resumes at the oldest
+    frame still in the ring, or at the newest one with `catch_up` set
+    (for latency bound consumers like detection). Frames overwritten while
+    a consumer was still using a view are counted as overwritten (see
+    `release`). With `max_fps` set the reader jumps to the newest frame once
+    per period, frames passed over that way are counted as limited. With a
+    stride the reader only takes frames with seq % stride == offset, so a
+    group of readers can split the stream between them.
+    """
+    def __init__(self, ring, max_fps=None, stride=1, offset=0, catch_up=False,
+                 poll_interval=0.0005):
+        self.ring = ring
+        self.poll_interval = poll_interval
+        self.stride = stride
+        self.offset = offset % stride
+        self.catch_up = catch_up
+        self.min_period = 1.0 / max_fps if max_fps else 0.0
+        self.cursor = ring.head
+        self.last_read = 0.0
+        self.received = 0
+        self.dropped = 0
+        self.overwritten = 0
+        self.limited = 0
+
+    def _wait_time(self):
+        """ Time until the rate limit allows the next frame """
+        return self.last_read + self.min_period - time.monotonic()
+
+    def poll(self):
+        """ Non-blocking read of the next frame, None if there is none """
+        ring = self.ring
+        while True:
+            head = ring.head
+            if head <= self.cursor:
+                return None
+
+            if self.min_period:
+                if self._wait_time() > 0:
+                    return None
+                # Skip straight to the newest frame
+                newest = head - (head - self.offset) % self.stride
+                if newest - self.stride > self.cursor:
+                    self.limited += (newest - self.stride - self.cursor) // self.stride
+                    self.cursor = newest - self.stride
+
+            seq = self.next_seq(self.cursor + 1)
+            # The slot after the head can be in the middle of a write
+            oldest = self.next_seq(head - ring.num_slots + 2)
+            if seq < oldest:
+                # Fallen behind
+                resume = oldest
+                if self.catch_up:
+                    # The newest frame rather than the oldest one that is
+                    # about to be overwritten, with a stride of about the
+                    # ring size the newest of this reader can be gone already
+                    resume = max(head - (head - self.offset) % self.stride, oldest)
+                self.dropped += (resume - seq) // self.stride
+                seq = resume
+                # Counted once, even when resume isn't published yet
+                self.cursor = seq - self.stride
+            if seq > head:
+                return None
+
+            self.cursor = seq
+            frame = ring.view(seq)
+            if frame is None:
+                self.dropped += 1
+                continue
+            self.received += 1
+            self.last_read = time.monotonic()
+            return frame
+
+    def next_seq(self, seq):
+        """ First sequence number from seq on that belongs to this reader """
+        return seq + (self.offset - seq) % self.stride
+
+    def read(self, timeout=None):
+        """ Wait for the next frame, None on timeout """
+        frame = self.poll()
+        if frame is not None:
+            return frame
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while frame is None:
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            wait = max(self.poll_interval, self._wait_time())
+            if deadline is not None:
+                wait = min(wait, max(deadline - time.monotonic(), 0.0))
+            time.sleep(wait)
+            frame = self.poll()
+
+        return frame
+
+    def release(self, frame):
+        """
+        Finish using a zero-copy view, returns False (and counts it) if the
+        frame was overwritten while it was in use.
+        """
+        if self.ring.valid(frame):
+            return True
+        self.overwritten += 1
+        return False
+
+    def stats(self):
+        return dict(
+            received=self.received,
+            dropped=self.dropped,
+            overwritten=self.overwritten,
+            limited=self.limited,
+            skipped=self.ring.skipped,
+        )
@@ -56,6 +56,7 @@ class ImageSender():
         # Assign corresponding send methods for REQ/REP mode
         self.send_image = self.send_image_reqrep
         self.send_jpg   = self.send_jpg_reqrep
+        self.send_frame = self.send_frame_reqrep
 
     def init_pubsub(self, address):
         """Creates and inits a socket in PUB/SUB mode
@@ -69,6 +70,7 @@ class ImageSender():
         # Assign corresponding send methods for PUB/SUB mode
         self.send_image = self.send_image_pubsub
         self.send_jpg   = self.send_jpg_pubsub
+        self.send_frame = self.send_frame_pubsub
 
     def send_image(self, msg, image):
         """ This is a placeholder. This method will be set to either a REQ/REP
@@ -156,11 +158,54 @@ class ImageSender():
 
         self.zmq_socket.send_jpg(msg, jpg_buffer, copy=False)
 
-    def close(self):
+    def send_frame(self, msg, buffer, **meta):
+        """This is a placeholder. This method will be set to either a REQ/REP
+        or PUB/SUB sending method, depending on REQ_REP option value.
+        Arguments:
+          msg: image name or message text.
+          buffer: encoded frame.
+          meta: codec name and anything else needed to decode the frame.
+        Returns:
+          A text reply from hub in REQ/REP mode or nothing in PUB/SUB mode.
+        """
+        pass
+
+    def send_frame_reqrep(self, msg, buffer, **meta):
+        """Sends msg text, encoded frame and its metadata to hub computer in
+        REQ/REP mode.
+        Arguments:
+          msg: image name or message text.
+          buffer: encoded frame.
+          meta: codec name and anything else needed to decode the frame.
+        Returns:
+          A text reply from hub.
+        """
+
+        self.zmq_socket.send_jpg(msg, buffer, meta=meta, copy=False)
+        hub_reply = self.zmq_socket.recv()  # receive the reply message
+        return hub_reply
+
+    def send_frame_pubsub(self, msg, buffer, **meta):
+        """Sends msg text, encoded frame and its metadata to hub computer in
+        PUB/SUB mode.
+        Arguments:
+          msg: image name or message text.
+          buffer: encoded frame.
+          meta: codec name and anything else needed to decode the frame.
+        Returns:
+          Nothing; there is no reply from the hub computer in PUB/SUB mode.
+        """
+
+        self.zmq_socket.send_jpg(msg, buffer, meta=meta, copy=False)
+
+    def close(self, linger=None):
         """Closes the ZMQ socket and the ZMQ context.
+        Arguments:
+          linger: (optional) ms to wait for unsent messages, None waits
+                  until they are all sent.
         """
 
-        self.zmq_socket.close()
+        self.zmq_socket.close(linger=linger)
         self.zmq_context.term()
 
     def __enter__(self):
@@ -269,6 +314,18 @@ class ImageHub():
         msg, jpg_buffer = self.zmq_socket.recv_jpg(copy=False)
         return msg, jpg_buffer
 
+    def recv_frame(self, copy=False):
+        """Receives metadata and an encoded frame.
+        Arguments:
+          copy: (optional) zmq copy flag
+        Returns:
+          md: metadata dict, msg text under 'msg', codec under 'codec'
+          buffer: encoded frame
+        """
+
+        md, buffer = self.zmq_socket.recv_frame(copy=False)
+        return md, buffer
+
     def send_reply(self, reply_message=b'OK'):
         """Sends the zmq REP reply message.
         Arguments:
@@ -331,7 +388,8 @@ class SerializingSocket(zmq.Socket):
                  jpg_buffer=b'00',
                  flags=0,
                  copy=True,
-                 track=False):
+                 track=False,
+                 meta=None):
         """Send a jpg buffer with a text message.
         Sends a jpg bytestring of an OpenCV image.
         Also sends text msg, often the image name.
@@ -341,9 +399,10 @@ class SerializingSocket(zmq.Socket):
           flags: (optional) zmq flags.
           copy: (optional) zmq copy flag.
           track: (optional) zmq track flag.
+          meta: (optional) dict of extra metadata sent along with msg.
         """
 
-        md = dict(msg=msg, )
+        md = dict(msg=msg, **(meta or {}))
         self.send_json(md, flags | zmq.SNDMORE)
         return self.send(jpg_buffer, flags, copy=copy, track=track)
 
@@ -383,6 +442,21 @@ class SerializingSocket(zmq.Socket):
         jpg_buffer = self.recv(flags=flags, copy=copy, track=track)
         return (md['msg'], jpg_buffer)
 
+    def recv_frame(self, flags=0, copy=True, track=False):
+        """Receives an encoded frame with all of its metadata.
+        Arguments:
+          flags: (optional) zmq flags.
+          copy: (optional) zmq copy flag.
+          track: (optional) zmq track flag.
+        Returns:
+          md: metadata dict, text message under 'msg'.
+          buffer: encoded frame.
+        """
+
+        md = self.recv_json(flags=flags)  # metadata text
+        buffer = self.recv(flags=flags, copy=copy, track=track)
+        return (md, buffer)
+
 
 class SerializingContext(zmq.Context):
     _socket_class = SerializingSocket
\ No newline at end of file
@@ -0,0 +1,313 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+import cv2 as cv
+
+from .tools import (
+    detect_marker,
+    find_components,
+    filter_markers,
+    merge_distance,
+    sort_markers,
+    MARKER_DTYPE,
+)
+
+
+def merge_windows(windows):
+    """ Merge overlapping (x0, y0, x1, y1) windows until none overlap """
+    windows = [list(w) for w in windows]
+    merged = True
+    while merged:
+        merged = False
+        out = []
+        for w in windows:
+            for o in out:
+                if (w[0] < o[2] and o[0] < w[2] and
+                    w[1] < o[3] and o[1] < w[3]):
+                    o[0], o[1] = min(o[0], w[0]), min(o[1], w[1])
+                    o[2], o[3] = max(o[2], w[2]), max(o[3], w[3])
+                    merged = True
+                    break
+            else:
+                out.append(w)
+        windows = out
+
+    return [tuple(w) for w in windows]
+
+def truncated(stats, window, frame_shape):
+    """
+    Mask of components touching a window edge that is not a frame edge,
+    their stats are not the ones the full frame would give
+    """
+    x0, y0, x1, y1 = window
+    height, width = frame_shape[0], frame_shape[1]
+    left = stats[:, cv.CC_STAT_LEFT]
+    top = stats[:, cv.CC_STAT_TOP]
+    right = left + stats[:, cv.CC_STAT_WIDTH]
+    bottom = top + stats[:, cv.CC_STAT_HEIGHT]
+
+    return (
+        ((left == 0) & (x0 > 0)) |
+        ((top == 0) & (y0 > 0)) |
+        ((right == x1 - x0) & (x1 < width)) |
+        ((bottom == y1 - y0) & (y1 < height))
+    )
+
+def detect_in_windows(img, windows, config):
+    """
+    Run marker detection only inside the given windows. Returns the markers
+    and whether any blob was cut by a window edge.
+    """
+    objs = []
+    cut = False
+    for window in windows:
+        x0, y0, x1, y1 = window
+        stats, centroids = find_components(img[y0:y1, x0:x1], config)
+        inside = ~truncated(stats, window, img.shape)
+        cut |= not inside.all()
+        objs.append(filter_markers(
+            stats[inside],
+            centroids[inside],
+            config,
+            img.shape,
+            offset=(x0, y0),
+        ))
+
+    objs = np.concatenate(objs) if objs else np.empty(0, dtype=MARKER_DTYPE)
+
+    return sort_markers(objs), cut
+
+
+class WindowedDetector():
+    """
+    Stateful detect_marker that only looks at padded windows around the
+    markers found in the previous frame.
+
+    Bright pixels outside those windows (anything above BIN_THR on the
+    frame max pooled over COARSE_SCALE tiles) get windows of their own, as
+    in PyramidDetector, so a new marker is picked up on the frame it first
+    passes the filter, wherever it shows up. A full frame scan is done
+    every TRACK_FULL_EVERY frames and whenever a marker is lost or a blob
+    runs off its window.
+    """
+    def __init__(self, config):
+        self.config = config
+        # Pixels added around the marker, has to cover the motion between
+        # two frames and the merge distance
+        self.pad = config.get("TRACK_PAD", 2 * merge_distance(config))
+        self.full_every = config.get("TRACK_FULL_EVERY", 30)
+        self.scale = config.get("COARSE_SCALE", 16)
+        self.threshold = config["BIN_THR"]
+        # Tiles a closing can bridge, grown around every bright tile
+        self.grow = -(-merge_distance(config) // self.scale)
+        self.markers = np.empty(0, dtype=MARKER_DTYPE)
+        self.since_full = 0
+        self.full_scans = 0
+        self.window_scans = 0
+        # Window scans that also searched bright tiles outside the tracks
+        self.blob_scans = 0
+
+    def windows(self, frame_shape):
+        height, width = frame_shape[0], frame_shape[1]
+        half = self.markers["r"] + self.pad
+        x, y = self.markers["x"], self.markers["y"]
+        windows = np.stack([
+            np.maximum(np.floor(x - half), 0),
+            np.maximum(np.floor(y - half), 0),
+            np.minimum(np.ceil(x + half), width),
+            np.minimum(np.ceil(y + half), height),
+        ], axis=1).astype(int)
+        return merge_windows(windows.tolist())
+
+    def outside(self, img, windows):
+        """ Bright tiles not entirely inside the windows """
+        scale = self.scale
+        bright = coarse_max(img, scale) > self.threshold
+        height, width = img.shape[0], img.shape[1]
+        for x0, y0, x1, y1 in windows:
+            # Only the tiles entirely inside the window, the padded tiles
+            # past the frame edge count as inside
+            bright[
+                -(-y0 // scale):(y1 // scale if y1 < height else None),
+                -(-x0 // scale):(x1 // scale if x1 < width else None),
+            ] = False
+        return bright
+
+    def full_scan(self, img):
+        self.since_full = 0
+        self.full_scans += 1
+        self.markers = detect_marker(img, self.config)
+        return self.markers
+
+    def __call__(self, img):
+        self.since_full += 1
+        if not len(self.markers) or self.since_full >= self.full_every:
+            return self.full_scan(img)
+
+        windows = self.windows(img.shape)
+        bright = self.outside(img, windows)
+        if bright.any():
+            # New markers, blobs that aren't markers (yet) or markers
+            # moving faster than the pad
+            self.blob_scans += 1
+            windows = merge_windows(
+                windows + tile_windows(bright, self.scale, self.grow, img.shape))
+
+        objs, cut = detect_in_windows(img, windows, self.config)
+        if cut or not tracked(objs, self.markers, self.pad):
+            # A blob larger than its window or a track lost, look at the
+            # whole frame again
+            return self.full_scan(img)
+
+        self.window_scans += 1
+        self.markers = objs
+        return objs
+
+    def reset(self):
+        self.markers = np.empty(0, dtype=MARKER_DTYPE)
+
+
+def tracked(objs, markers, pad):
+    """ Whether every marker has one of objs within pad of it """
+    if not len(markers):
+        return True
+    if len(objs) < len(markers):
+        return False
+    dist = np.hypot(
+        markers["x"][:, None] - objs["x"][None, :],
+        markers["y"][:, None] - objs["y"][None, :],
+    )
+    return bool((dist.min(axis=1) <= pad).all())
+
+def tile_windows(bright, scale, grow, frame_shape):
+    """ Pixel windows around the groups of bright tiles, grown by grow tiles """
+    size = 2 * grow + 1
+    bright = cv.dilate(
+        bright.astype(np.uint8),
+        cv.getStructuringElement(cv.MORPH_RECT, (size, size)),
+    )
+    num_labels, _, stats, _ = cv.connectedComponentsWithStats(
+        bright, 8, cv.CV_32S)
+
+    height, width = frame_shape[0], frame_shape[1]
+    stats = stats[1:] * scale
+    x0 = stats[:, cv.CC_STAT_LEFT]
+    y0 = stats[:, cv.CC_STAT_TOP]
+    x1 = np.minimum(x0 + stats[:, cv.CC_STAT_WIDTH], width)
+    y1 = np.minimum(y0 + stats[:, cv.CC_STAT_HEIGHT], height)
+
+    return merge_windows(np.stack([x0, y0, x1, y1], axis=1).tolist())
+
+
+def coarse_max(img, scale):
+    """ Max pooling of the image over scale x scale tiles """
+    height, width = img.shape[0], img.shape[1]
+    pad_h, pad_w = -height % scale, -width % scale
+    if pad_h or pad_w:
+        img = np.pad(img, ((0, pad_h), (0, pad_w)))
+        height, width = img.shape[0], img.shape[1]
+    # Rows first, the reduction runs over whole contiguous rows
+    rows = img.reshape(height // scale, scale, width).max(axis=1)
+
+    return rows.reshape(height // scale, width // scale, scale).max(axis=2)
+
+
+class PyramidDetector():
+    """
+    Coarse-to-fine detect_marker.
+
+    Frames with no pixel above BIN_THR are skipped outright. Otherwise the
+    frame is max pooled over COARSE_SCALE tiles, bright tiles are grown by
+    the closing kernel and grouped, and the full resolution detection runs
+    only on the windows covering those groups. Markers come out the same
+    as from detect_marker.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.scale = config.get("COARSE_SCALE", 16)
+        self.threshold = config["BIN_THR"]
+        # Tiles a closing can bridge, grown around every bright tile
+        self.grow = -(-merge_distance(config) // self.scale)
+        self.skipped = 0
+        self.frames = 0
+
+    def windows(self, img):
+        """ Pixel windows around the groups of bright tiles """
+        bright = coarse_max(img, self.scale) > self.threshold
+        return tile_windows(bright, self.scale, self.grow, img.shape)
+
+    def __call__(self, img):
+        self.frames += 1
+        if cv.minMaxLoc(img)[1] <= self.threshold:
+            # Nothing bright, nothing to detect
+            self.skipped += 1
+            return np.empty(0, dtype=MARKER_DTYPE)
+
+        objs, _ = detect_in_windows(img, self.windows(img), self.config)
+        return objs
+
+
+class StripedDetector():
+    """
+    detect_marker split over horizontal stripes processed by a thread pool,
+    OpenCV releases the GIL so the stripes run on separate cores.
+
+    Every stripe is processed with STRIPE_OVERLAP extra rows on both sides
+    and keeps the components whose top row lies inside it, so a component
+    crossing a seam is reported once, with the stats of the whole blob.
+    Blobs taller than the overlap can't be told apart from cut ones and
+    are dropped, the overlap should be above the largest marker size.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.stripes = config.get("STRIPES") or os.cpu_count()
+        self.overlap = config.get(
+            "STRIPE_OVERLAP", 
+            config["BALL_SIZE"] + merge_distance(config),
+        )
+        self.pool = ThreadPoolExecutor(max_workers=self.stripes)
+
+    def _stripe(self, img, start, stop):
+        height, width = img.shape[0], img.shape[1]
+        y0 = max(start - self.overlap, 0)
+        y1 = min(stop + self.overlap, height)
+        stats, centroids = find_components(img[y0:y1], self.config)
+
+        top = stats[:, cv.CC_STAT_TOP] + y0
+        own = (
+            (top >= start) & (top < stop) &
+            ~truncated(stats, (0, y0, width, y1), img.shape)
+        )
+        return filter_markers(
+            stats[own],
+            centroids[own],
+            self.config,
+            img.shape,
+            offset=(0, y0),
+        )
+
+    def __call__(self, img):
+        bounds = np.linspace(0, img.shape[0], self.stripes + 1).astype(int)
+        parts = self.pool.map(
+            lambda stripe: self._stripe(img, *stripe),
+            zip(bounds[:-1], bounds[1:]),
+        )
+        return sort_markers(np.concatenate(list(parts)))
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def make_detector(config):
+    """ Marker detector selected by MODE in the POST_PROC config """
+    mode = config.get("MODE", "full")
+    if mode == "full":
+        return lambda img: detect_marker(img, config)
+    if mode == "tracking":
+        return WindowedDetector(config)
+    if mode == "pyramid":
+        return PyramidDetector(config)
+    if mode == "striped":
+        return StripedDetector(config)
+    raise ValueError(f"Unknown detection mode {mode}")
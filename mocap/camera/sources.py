@@ -0,0 +1,275 @@
+from pathlib import Path
+import threading
+import time
+
+import numpy as np
+import cv2 as cv
+
+try:
+    from pypylon import pylon
+except ImportError:
+    # Synthetic and replay sources work without pylon installed
+    pylon = None
+
+
+class FrameSource():
+    """
+    Base class for everything that can feed frames into a FrameRing.
+
+    open() has to set WIDTH, HEIGHT and serial, start() begins publishing
+    frames to the ring on a background thread until stop() is called.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.fps = config.get("FPS", 60)
+        self.WIDTH = None
+        self.HEIGHT = None
+        self.serial = None
+
+    def open(self):
+        raise NotImplementedError
+
+    def start(self, frame_ring):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def is_grabbing(self):
+        raise NotImplementedError
+
+
+class ThreadedSource(FrameSource):
+    """ Source publishing frames from its own thread at a fixed rate """
+    def __init__(self, config):
+        super().__init__(config)
+        self._thread = None
+        self._stop = threading.Event()
+
+    def frames(self):
+        """ Generator of (image, camera timestamp in ns) """
+        raise NotImplementedError
+
+    def start(self, frame_ring):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(frame_ring,),
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, frame_ring):
+        # FPS of 0 or None runs as fast as possible
+        period = 1.0 / self.fps if self.fps else 0.0
+        next_t = time.perf_counter()
+        for img, cam_ts in self.frames():
+            if self._stop.is_set():
+                break
+            if period:
+                delay = next_t - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_t += period
+            frame_ring.publish(img, cam_ts)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def is_grabbing(self):
+        return self._thread is not None and self._thread.is_alive()
+
+
+class SyntheticSource(ThreadedSource):
+    """
+    Renders bright round markers moving on Lissajous curves over a dark,
+    slightly noisy background.
+    """
+    def __init__(self, config):
+        super().__init__(config)
+        synth = config.get("SYNTHETIC", {})
+        self.WIDTH = synth.get("WIDTH", 1920)
+        self.HEIGHT = synth.get("HEIGHT", 1200)
+        self.num_markers = synth.get("MARKERS", 10)
+        self.radius = synth.get("RADIUS", 8)
+        # Marker speed in cycles per second
+        self.speed = synth.get("SPEED", 0.2)
+        self.noise = synth.get("NOISE", 20)
+        self.serial = "synthetic"
+
+        rng = np.random.default_rng(synth.get("SEED", 0))
+        self._freq = rng.uniform(0.5, 1.5, (self.num_markers, 2))
+        self._phase = rng.uniform(0, 2*np.pi, (self.num_markers, 2))
+        self._background = rng.integers(
+            0,
+            self.noise + 1,
+            (self.HEIGHT, self.WIDTH),
+            dtype=np.uint8,
+        )
+
+    def open(self):
+        return self.WIDTH, self.HEIGHT
+
+    def marker_positions(self, t):
+        """ Marker centres (x, y) at time t in seconds """
+        margin = 2 * self.radius
+        half = np.array([self.WIDTH, self.HEIGHT]) / 2 - margin
+        angle = 2*np.pi*self.speed*self._freq*t + self._phase
+        return np.array([self.WIDTH, self.HEIGHT]) / 2 + half*np.sin(angle)
+
+    def render(self, t):
+        img = self._background.copy()
+        for x, y in self.marker_positions(t):
+            cv.circle(img, (int(x), int(y)), self.radius, 255, -1)
+        return img
+
+    def frames(self):
+        period = 1.0 / self.fps if self.fps else 1.0 / 60
+        i = 0
+        while True:
+            t = i * period
+            yield self.render(t), int(t * 1e9)
+            i += 1
+
+
+class ReplaySource(ThreadedSource):
+    """
+    Streams a recorded BMP/JPEG sequence at the configured FPS, or as fast
+    as possible with FPS set to 0.
+    """
+    def __init__(self, config):
+        super().__init__(config)
+        replay = config.get("REPLAY", {})
+        self.path = Path(replay["PATH"])
+        self.patterns = replay.get("PATTERNS", ["*.bmp", "*.jpg", "*.jpeg"])
+        self.loop = replay.get("LOOP", False)
+        # Decode everything up front so disk speed doesn't limit the rate
+        self.preload = replay.get("PRELOAD", True)
+        self.serial = f"replay-{self.path.name}"
+        self._files = []
+        self._images = None
+
+    def open(self):
+        files = []
+        for pattern in self.patterns:
+            files.extend(self.path.glob(pattern))
+        self._files = sorted(files)
+        if not self._files:
+            raise FileNotFoundError(f"No images to replay in {self.path}")
+
+        if self.preload:
+            self._images = [self._read(f) for f in self._files]
+        img = self._images[0] if self.preload else self._read(self._files[0])
+        self.HEIGHT, self.WIDTH = img.shape[:2]
+
+        return self.WIDTH, self.HEIGHT
+
+    def _read(self, file):
+        return cv.imread(str(file), cv.IMREAD_GRAYSCALE)
+
+    def frames(self):
+        period = 1.0 / self.fps if self.fps else 1.0 / 60
+        i = 0
+        while True:
+            for n, file in enumerate(self._files):
+                img = self._images[n] if self.preload else self._read(file)
+                yield img, int(i * period * 1e9)
+                i += 1
+            if not self.loop:
+                break
+
+
+if pylon is not None:
+    # Example of an image event handler.
+    class SampleImageEventHandler(pylon.ImageEventHandler):
+        def __init__(self, frame_ring, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.frame_ring = frame_ring
+
+        def OnImageGrabbed(self, camera, grabResult):
+            if grabResult.GrabSucceeded():
+                grab_ts = time.time_ns()
+                with grabResult.GetArrayZeroCopy() as img:
+                    self.frame_ring.publish(
+                        img,
+                        grabResult.GetTimeStamp(),
+                        grab_ts,
+                    )
+
+        def OnImagesSkipped(self, camera, countOfSkippedImages):
+            self.frame_ring.count_skipped(countOfSkippedImages)
+
+
+class PylonSource(FrameSource):
+    """ First Basler camera found, grabbed by the pylon grab loop thread """
+    def __init__(self, config):
+        super().__init__(config)
+        if pylon is None:
+            raise ImportError("pypylon is required for the pylon frame source")
+        self.exposure = config.get("EXPOSURE", 10000.0)
+        self.hard_trigg = config.get("HARD_TRIGG", False)
+        self.camera = None
+
+    def open(self):
+        # Connect camera
+        self.camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
+        self.serial = self.camera.GetDeviceInfo().GetSerialNumber()
+
+        self.camera.Open()
+        # Set fps
+        self.camera.AcquisitionFrameRateEnable.SetValue(True)
+        self.camera.AcquisitionFrameRate.SetValue(self.fps)
+        # Set exposure time
+        self.camera.ExposureTime.SetValue(self.exposure)
+        # Set pixel format to mono
+        self.camera.PixelFormat.SetValue("Mono8")
+        self.WIDTH = self.camera.Width.GetValue()
+        self.HEIGHT = self.camera.Height.GetValue()
+
+        self.camera.Close()
+
+        if self.hard_trigg:
+            # TODO - add as a hardware trigger
+            self.camera.RegisterConfiguration(
+                pylon.SoftwareTriggerConfiguration(),
+                pylon.RegistrationMode_ReplaceAll,
+                pylon.Cleanup_Delete,
+            )
+
+        return self.WIDTH, self.HEIGHT
+
+    def start(self, frame_ring):
+        self.camera.RegisterImageEventHandler(
+            SampleImageEventHandler(frame_ring),
+            pylon.RegistrationMode_ReplaceAll,
+            pylon.Cleanup_Delete,
+        )
+        self.camera.StartGrabbing(
+            # pylon.GrabStrategy_OneByOne,
+            pylon.GrabStrategy_LatestImageOnly,
+            pylon.GrabLoop_ProvidedByInstantCamera,
+        )
+
+    def stop(self):
+        self.camera.StopGrabbing()
+
+    def is_grabbing(self):
+        return self.camera.IsGrabbing()
+
+
+SOURCES = {
+    "pylon": PylonSource,
+    "synthetic": SyntheticSource,
+    "replay": ReplaySource,
+}
+
+def create_source(config):
+    """ Build the frame source selected by SOURCE in the camera config """
+    name = config.get("SOURCE", "pylon")
+    if name not in SOURCES:
+        raise ValueError(
+            f"Unknown frame source {name}, expected one of {list(SOURCES)}")
+    return SOURCES[name](config)
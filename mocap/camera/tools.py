@@ -1,12 +1,11 @@
-from pypylon import genicam
-from pypylon import pylon
 import numpy as np
 import cv2 as cv
 
-import time
 import yaml
 import os
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 def read_config(config_file):
     with open(config_file, 'r') as f:
@@ -18,19 +17,41 @@ def save_img(img, every_n=1):
     """ Save image to a folder for furure calibration etc"""
     pass
 
+# One row per marker, as returned by detect_marker
+MARKER_DTYPE = np.dtype([
+    ("id", np.int32),
+    ("x", np.float64),
+    ("y", np.float64),
+    ("r", np.float64),
+    ("area", np.int32),
+    ("circularity", np.float64),
+])
+
+# MARKER_DTYPE with the undistorted normalized coordinates of the centroid
+UNDISTORTED_DTYPE = np.dtype(MARKER_DTYPE.descr + [
+    ("nx", np.float64),
+    ("ny", np.float64),
+])
+
 def detect_marker(img, config):
-    """ Detect circular markers on an image """
+    """ Detect circular markers on an image, returns a MARKER_DTYPE array """
+    stats, centroids = find_components(img, config)
+    
+    return filter_markers(stats, centroids, config, img.shape)
+
+def find_components(img, config):
+    """ 
+    Threshold the image and glue fragmented blobs together, returns stats
+    and centroids of the connected components without the background label.
+    Fragments are glued with a morphological close (MERGE: close, the
+    default) or by merging nearby components (MERGE: stats).
+    """
     # Parse config
     b_thr = config["BIN_THR"]
     k_size = config["KERNEL"]
-    c_thr = config["CIRC_THR"]
-    w_h_diff = config["W_H_DIFF"]
-    b_size = config["BALL_SIZE"]
-    area_thr = config["AREA_THR"]
-    
-    # Do image processing
-    height, width = img.shape[0], img.shape[1]
+    merge = config.get("MERGE", "close")
 
+    # Do image processing
     _, thr = cv.threshold(
         img, 
         b_thr, 
@@ -38,108 +59,353 @@ def detect_marker(img, config):
         cv.THRESH_BINARY,
     )
     
-    # return thr
-    kernel = cv.getStructuringElement(
-        cv.MORPH_RECT,
-        (k_size,k_size),
-    )
-    closing = cv.morphologyEx(
-        thr, 
-        cv.MORPH_CLOSE, 
-        kernel,
-    )
-    # return closing
+    if merge == "close":
+        kernel = cv.getStructuringElement(
+            cv.MORPH_RECT,
+            (k_size,k_size),
+        )
+        thr = cv.morphologyEx(
+            thr, 
+            cv.MORPH_CLOSE, 
+            kernel,
+        )
+    elif merge != "stats":
+        raise ValueError(f"Unknown merge strategy {merge}")
 
     connectivity = 8
     res =  cv.connectedComponentsWithStats(
-        closing,
+        thr,
         connectivity,
         cv.CV_32S,
     )
     num_labels, labels, stats, centroids = res
-    objs = []
-    cnt = 0
+    stats, centroids = stats[1:], centroids[1:]
+
+    if merge == "stats":
+        stats, centroids = merge_components(
+            stats, 
+            centroids, 
+            config.get("MERGE_GAP", k_size - 1),
+        )
+
+    return stats, centroids
+
+def merge_distance(config):
+    """ Largest gap in pixels that find_components glues over, plus one """
+    if config.get("MERGE", "close") == "stats":
+        return config.get("MERGE_GAP", config["KERNEL"] - 1) + 1
+    return config["KERNEL"]
+
+def merge_components(stats, centroids, gap, block=1024):
+    """ 
+    Merge components whose bounding boxes are at most gap pixels apart,
+    area, bounding box and centroid are recomputed from the merged stats.
+    Merged components keep the position of their first (scan order) part.
+    """
+    n = len(stats)
+    if n < 2:
+        return stats, centroids
+    left = stats[:, cv.CC_STAT_LEFT]
+    top = stats[:, cv.CC_STAT_TOP]
+    right = left + stats[:, cv.CC_STAT_WIDTH]
+    bottom = top + stats[:, cv.CC_STAT_HEIGHT]
+    area = stats[:, cv.CC_STAT_AREA]
+
+    # Pairs of close boxes, in blocks of rows to bound the memory used
+    first, second = [], []
+    for start in range(0, n, block):
+        rows = slice(start, start + block)
+        dx = np.maximum(left[None, :] - right[rows, None], left[rows, None] - right[None, :])
+        dy = np.maximum(top[None, :] - bottom[rows, None], top[rows, None] - bottom[None, :])
+        i, j = np.nonzero((dx <= gap) & (dy <= gap))
+        i += start
+        pair = i < j
+        first.append(i[pair])
+        second.append(j[pair])
+    first, second = np.concatenate(first), np.concatenate(second)
+    if not len(first):
+        return stats, centroids
+
+    # Label propagation, every group ends up labelled with its lowest index
+    labels = np.arange(n)
+    while True:
+        low = np.minimum(labels[first], labels[second])
+        new = labels.copy()
+        np.minimum.at(new, first, low)
+        np.minimum.at(new, second, low)
+        new = new[new]
+        if np.array_equal(new, labels):
+            break
+        labels = new
+
+    roots, group = np.unique(labels, return_inverse=True)
+    merged_area = np.bincount(group, area)
+    merged_left = np.full(len(roots), np.iinfo(np.int32).max)
+    merged_top = merged_left.copy()
+    merged_right = np.zeros(len(roots), dtype=np.int64)
+    merged_bottom = merged_right.copy()
+    np.minimum.at(merged_left, group, left)
+    np.minimum.at(merged_top, group, top)
+    np.maximum.at(merged_right, group, right)
+    np.maximum.at(merged_bottom, group, bottom)
+
+    merged_stats = np.empty((len(roots), stats.shape[1]), dtype=stats.dtype)
+    merged_stats[:, cv.CC_STAT_LEFT] = merged_left
+    merged_stats[:, cv.CC_STAT_TOP] = merged_top
+    merged_stats[:, cv.CC_STAT_WIDTH] = merged_right - merged_left
+    merged_stats[:, cv.CC_STAT_HEIGHT] = merged_bottom - merged_top
+    merged_stats[:, cv.CC_STAT_AREA] = merged_area
+    merged_centroids = np.stack([
+        np.bincount(group, centroids[:, 0] * area) / merged_area,
+        np.bincount(group, centroids[:, 1] * area) / merged_area,
+    ], axis=1)
+
+    return merged_stats, merged_centroids
+
+def filter_markers(stats, centroids, config, frame_shape, offset=(0, 0)):
+    """ 
+    Keep the components that look like markers. Stats and centroids can
+    come from a window of the frame, offset is the (x, y) of its corner.
+    Returns a MARKER_DTYPE array.
+    """
+    # Parse config
+    c_thr = config["CIRC_THR"]
+    w_h_diff = config["W_H_DIFF"]
+    b_size = config["BALL_SIZE"]
+    area_thr = config["AREA_THR"]
+    
+    height, width = frame_shape[0], frame_shape[1]
+    off_x, off_y = offset
     
-    for i in range(1, num_labels):
-        x, y = centroids[i]
-        w = stats[i, cv.CC_STAT_WIDTH]
-        h = stats[i, cv.CC_STAT_HEIGHT]
-        r = (w + h) / 2
-        area = stats[i, cv.CC_STAT_AREA]
-        circularity = np.pi * r**2/(area)
-
-        if (area >= area_thr and 
-            circularity > c_thr and 
-            abs(w - h) <= w_h_diff and
-            x-b_size>=0 and x+b_size<=width and
-            y-b_size>=0 and y+b_size<=height):
-            # print(area)
-            objs.append((cnt, *centroids[i], r))
-            cnt += 1  
-
-    return objs 
+    x = centroids[:, 0] + off_x
+    y = centroids[:, 1] + off_y
+    w = stats[:, cv.CC_STAT_WIDTH]
+    h = stats[:, cv.CC_STAT_HEIGHT]
+    r = (w + h) / 2
+    area = stats[:, cv.CC_STAT_AREA]
+    circularity = np.pi * r**2/area
 
-def get_calibration_results(imgs_path, config):
-    ROWS, COLS = config["ROWS"], config["COLS"]
+    keep = (
+        (area >= area_thr) &
+        (circularity > c_thr) &
+        (np.abs(w - h) <= w_h_diff) &
+        (x-b_size >= 0) & (x+b_size <= width) &
+        (y-b_size >= 0) & (y+b_size <= height)
+    )
+    
+    objs = np.empty(np.count_nonzero(keep), dtype=MARKER_DTYPE)
+    objs["x"] = x[keep]
+    objs["y"] = y[keep]
+    objs["r"] = r[keep]
+    objs["area"] = area[keep]
+    objs["circularity"] = circularity[keep]
+
+    return sort_markers(objs)
+
+def sort_markers(objs):
+    """ 
+    Order markers by (y, x) and number them, so detections of the same
+    frame come out the same whichever way the frame was split up
+    """
+    objs = objs[np.lexsort((objs["x"], objs["y"]))]
+    objs["id"] = np.arange(len(objs))
+    
+    return objs
+
+def find_chessboard(img, rows, cols, search_width=None):
+    """
+    Chessboard corners refined to subpixel, None if there is no board.
+    With search_width the board is searched on the image scaled down to
+    that width, the corners are refined on the full image.
+    """
     # termination criteria
     criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-    # prepare object points, like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0)
-    objp = np.zeros((ROWS*COLS,3), np.float32)
-    objp[:,:2] = np.mgrid[0:COLS,0:ROWS].T.reshape(-1,2)
-    
-    # Arrays to store object points and image points from all the images.
-    objpoints = [] # 3d point in real world space
-    imgpoints = [] # 2d points in image plane.
+    # The full search can take seconds on a frame without a board, the
+    # fast check bails out early (checked explicitly too, some OpenCV
+    # versions search anyway)
+    flags = cv.CALIB_CB_ADAPTIVE_THRESH + cv.CALIB_CB_NORMALIZE_IMAGE + cv.CALIB_CB_FAST_CHECK
+    scale = 1.0
+    search = img
+    if search_width and img.shape[1] > search_width:
+        scale = img.shape[1] / search_width
+        search = cv.resize(
+            img,
+            (search_width, round(img.shape[0] / scale)),
+            interpolation=cv.INTER_AREA,
+        )
+    if not cv.checkChessboard(search, (cols, rows)):
+        return None
+    ret, corners = cv.findChessboardCorners(search, (cols, rows), flags)
+    if not ret:
+        return None
+    if scale != 1.0:
+        # Pixel centres of the small image back to the full one
+        corners = ((corners + 0.5) * scale - 0.5).astype(np.float32)
+
+    return cv.cornerSubPix(img, corners, (11,11), (-1,-1), criteria)
+
+def chessboard_points(rows, cols):
+    """ Board corners in board units, like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0) """
+    objp = np.zeros((rows*cols,3), np.float32)
+    objp[:,:2] = np.mgrid[0:cols,0:rows].T.reshape(-1,2)
+    return objp
+
+def view_features(views, rows, cols, image_size):
+    """
+    Pose features of chessboard views, one row per view: board centre and
+    size relative to the image, in-plane rotation (as cos, sin of twice the
+    angle, the corner order can flip by 180 deg) and the tilt about both
+    board axes from the foreshortening of opposite edges
+    """
+    grid = np.stack(views).reshape(len(views), rows, cols, 2)
+    size = np.asarray(image_size, dtype=np.float64)
+    p00, p01 = grid[:, 0, 0], grid[:, 0, -1]
+    p10, p11 = grid[:, -1, 0], grid[:, -1, -1]
+    # Shoelace area of the board outline
+    quad = np.stack([p00, p01, p11, p10], axis=1)
+    area = 0.5 * np.abs(np.sum(
+        quad[:, :, 0] * np.roll(quad[:, :, 1], -1, axis=1) -
+        quad[:, :, 1] * np.roll(quad[:, :, 0], -1, axis=1),
+        axis=1,
+    ))
+    top = np.linalg.norm(p01 - p00, axis=1)
+    bottom = np.linalg.norm(p11 - p10, axis=1)
+    left = np.linalg.norm(p10 - p00, axis=1)
+    right = np.linalg.norm(p11 - p01, axis=1)
+    angle = 2 * np.arctan2(*(p01 - p00).T[::-1])
+
+    return np.column_stack([
+        grid.mean(axis=(1, 2)) / size,
+        np.sqrt(area / size.prod()),
+        np.cos(angle),
+        np.sin(angle),
+        (top - bottom) / (top + bottom),
+        (left - right) / (left + right),
+    ])
+
+# Change of every view_features column that makes a clearly different view:
+# a quarter of the image, a tenth in board size, ~15 deg of in-plane
+# rotation and ~15 deg of tilt of a board a third of the image wide
+VIEW_FEATURE_SCALE = np.array([0.25, 0.25, 0.1, 0.5, 0.5, 0.03, 0.03])
+
+def select_views(views, rows, cols, image_size, max_views):
+    """
+    Indices of at most max_views views spread as far apart as possible in
+    pose (farthest point sampling on view_features), starting with the
+    largest board
+    """
+    if len(views) <= max_views:
+        return np.arange(len(views))
+    features = view_features(views, rows, cols, image_size)
+    chosen = [int(np.argmax(features[:, 2]))]
+    # Every feature in units of a clearly different pose, the raw rotation
+    # columns span 2 and would drown the tilts (~0.1)
+    features = features / VIEW_FEATURE_SCALE
+    dist = np.linalg.norm(features - features[chosen[0]], axis=1)
+    while len(chosen) < max_views:
+        best = int(np.argmax(dist))
+        chosen.append(best)
+        dist = np.minimum(dist, np.linalg.norm(features - features[best], axis=1))
+
+    return np.sort(chosen)
+
+def coverage_stats(views, rows, cols, image_size, grid=8):
+    """ How well the views cover the image and the range of board poses """
+    width, height = image_size
+    points = np.stack(views).reshape(-1, 2)
+    cell_x = np.clip((points[:, 0] * grid / width).astype(int), 0, grid - 1)
+    cell_y = np.clip((points[:, 1] * grid / height).astype(int), 0, grid - 1)
+    features = view_features(views, rows, cols, image_size)
+
+    def span(column):
+        return tuple(np.round([column.min(), column.max()], 3).tolist())
+
+    return dict(
+        views=len(views),
+        # Fraction of the grid x grid image cells with a corner in them
+        coverage=round(len(np.unique(cell_y * grid + cell_x)) / grid**2, 3),
+        # (min, max) over the views
+        size=span(features[:, 2]),
+        tilt_x=span(features[:, 5]),
+        tilt_y=span(features[:, 6]),
+    )
+
+def _image_corners(frame, rows, cols, vis_dir=None):
+    """ Corners of a single calibration image, run in the worker processes """
+    img = cv.imread(str(frame), -1)
+    corners = find_chessboard(img, rows, cols)
+    if corners is not None and vis_dir is not None:
+        # Draw on a colour copy so the corners stand out
+        vis = cv.cvtColor(img, cv.COLOR_GRAY2BGR) if img.ndim == 2 else img
+        cv.drawChessboardCorners(vis, (cols, rows), corners, True)
+        cv.imwrite(str(Path(vis_dir) / f"{Path(frame).stem}_corners.png"), vis)
+
+    return img.shape, corners
+
+def get_calibration_results(imgs_path, config):
+    """
+    Calibrate the camera from the chessboard images (*.bmp) in imgs_path.
+
+    With CALIB.HEADLESS (default) the corners of all images are found in
+    parallel by WORKERS processes (None means cpu_count) and nothing is
+    shown. Images with the detected corners drawn go to VIS_DIR if set.
+    HEADLESS false shows every detected board instead, as before. At most
+    MAX_VIEWS of the views, the most diverse ones, are calibrated on.
+    """
+    ROWS, COLS = config["ROWS"], config["COLS"]
+    headless = config.get("HEADLESS", True)
+    vis_dir = config.get("VIS_DIR")
+    if vis_dir is not None:
+        Path(vis_dir).mkdir(parents=True, exist_ok=True)
+    objp = chessboard_points(ROWS, COLS)
     
-    # Extract images from the directory 
-    imgs_path = Path(imgs_path)
+    # Find all images, sorted so the views come in the order they were taken
+    imgs = sorted(Path(imgs_path).glob("*.bmp"))
+    if not imgs:
+        raise FileNotFoundError(f"No calibration images in {imgs_path}")
+
+    if headless:
+        with ProcessPoolExecutor(max_workers=config.get("WORKERS")) as pool:
+            results = list(pool.map(
+                _image_corners,
+                imgs,
+                repeat(ROWS),
+                repeat(COLS),
+                repeat(vis_dir),
+            ))
+    else:
+        results = []
+        for frame in imgs:
+            shape, corners = _image_corners(frame, ROWS, COLS, vis_dir)
+            results.append((shape, corners))
+            if corners is not None:
+                # Draw and display the corners
+                img = cv.imread(str(frame), -1)
+                cv.drawChessboardCorners(img, (COLS,ROWS), corners, True)
+                cv.imshow('img', img)
+                cv.waitKey(500)
+        cv.destroyAllWindows()
     
-    # Find all images
-    imgs = imgs_path.glob("*.bmp")
-    for frame in imgs:
-        img = cv.imread(str(frame), -1)
-        print(img.shape)
-         # Find the chess board corners
-        ret, corners = cv.findChessboardCorners(img, (COLS,ROWS), None)
-        # If found, add object points, image points (after refining them)
-        if ret == True:
-            objpoints.append(objp)
-            corners2 = cv.cornerSubPix(img,corners, (11,11), (-1,-1), criteria)
-            imgpoints.append(corners2)
-            # Draw and display the corners
-            cv.drawChessboardCorners(img, (COLS,ROWS), corners2, ret)
-            cv.imshow('img', img)
-            cv.waitKey(500)
-            
-    cv.destroyAllWindows()
+    # 3d points in real world space and 2d points in image plane
+    imgpoints = [corners for _, corners in results if corners is not None]
+    print(f"Chessboard found on {len(imgpoints)} of {len(imgs)} images")
+    image_size = results[0][0][::-1]
+    keep = select_views(
+        imgpoints, ROWS, COLS, image_size, config.get("MAX_VIEWS", 20))
+    imgpoints = [imgpoints[i] for i in keep]
+    objpoints = [objp] * len(imgpoints)
+    print("Calibration views:", coverage_stats(imgpoints, ROWS, COLS, image_size))
     
     calib_res = cv.calibrateCamera(
         objpoints, 
         imgpoints, 
-        img.shape[::-1], 
+        image_size, 
         None, 
         None,
     )
     
     return calib_res
 
-# Example of an image event handler.
-class SampleImageEventHandler(pylon.ImageEventHandler):
-    def __init__(self, pipe_out, shared_arr, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.pipe_out = pipe_out
-        self.shared_arr = shared_arr
-        self.shared_arr_np = np.frombuffer(self.shared_arr.get_obj(), dtype=np.uint8)
-        self.cnt=0
-        
-    def OnImageGrabbed(self, camera, grabResult):
-        if grabResult.GrabSucceeded():
-            img = grabResult.GetArray()
-            with self.shared_arr.get_lock():
-                self.shared_arr_np[:] = img.reshape(-1)
-            # self.pipe_out.send(time.perf_counter_ns())
-            self.pipe_out.send("OK")
-
 class ImageSaver():
     """ 
     Simple class for saving images to a temporary dir,
@@ -0,0 +1,346 @@
+"""
+Frame codecs shared by the camera nodes and the server.
+
+The sender puts the codec name and whatever the codec needs to decode the
+frame (shape, quality, ...) in the message metadata, the receiver looks the
+codec up by that name, so every node can pick its own codec.
+"""
+import threading
+import struct
+import time
+import zlib
+
+import numpy as np
+import cv2 as cv
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Codec():
+    """ Encodes mono8 frames to bytes and back """
+    name = None
+
+    def encode(self, img):
+        """ Returns the payload and the metadata needed to decode it """
+        raise NotImplementedError
+
+    def decode(self, payload, meta):
+        raise NotImplementedError
+
+
+class RawCodec(Codec):
+    """ Frame bytes as they are """
+    name = "raw"
+
+    def encode(self, img):
+        # Copy, the frame may live in the ring and zmq sends asynchronously
+        return img.tobytes(), dict(shape=img.shape)
+
+    def decode(self, payload, meta):
+        return np.frombuffer(payload, dtype=np.uint8).reshape(meta["shape"])
+
+
+class JpegCodec(Codec):
+    name = "jpeg"
+
+    def __init__(self, quality=95):
+        self.quality = quality
+
+    def encode(self, img):
+        _, payload = cv.imencode(
+            ".jpg", img, [int(cv.IMWRITE_JPEG_QUALITY), self.quality])
+        return payload, dict(shape=img.shape)
+
+    def decode(self, payload, meta):
+        return cv.imdecode(np.frombuffer(payload, dtype=np.uint8), -1)
+
+
+class PngCodec(Codec):
+    name = "png"
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def encode(self, img):
+        _, payload = cv.imencode(
+            ".png", img, [int(cv.IMWRITE_PNG_COMPRESSION), self.level])
+        return payload, dict(shape=img.shape)
+
+    def decode(self, payload, meta):
+        return cv.imdecode(np.frombuffer(payload, dtype=np.uint8), -1)
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def encode(self, img):
+        return zlib.compress(img, self.level), dict(shape=img.shape)
+
+    def decode(self, payload, meta):
+        return np.frombuffer(
+            zlib.decompress(payload), dtype=np.uint8).reshape(meta["shape"])
+
+
+class Lz4Codec(Codec):
+    name = "lz4"
+
+    def __init__(self, level=0):
+        self.level = level
+
+    def encode(self, img):
+        payload = lz4.frame.compress(img, compression_level=self.level)
+        return payload, dict(shape=img.shape)
+
+    def decode(self, payload, meta):
+        return np.frombuffer(
+            lz4.frame.decompress(payload), dtype=np.uint8).reshape(meta["shape"])
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+
+    def __init__(self, level=1):
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def encode(self, img):
+        return self.compressor.compress(img), dict(shape=img.shape)
+
+    def decode(self, payload, meta):
+        return np.frombuffer(
+            self.decompressor.decompress(payload),
+            dtype=np.uint8,
+        ).reshape(meta["shape"])
+
+
+class SparseFrame():
+    """
+    Frame kept as the runs of bright pixels of every row, dense only on
+    request
+    """
+    def __init__(self, shape, rows, starts, lengths, values):
+        self.shape = shape
+        self.rows = rows
+        self.starts = starts
+        self.lengths = lengths
+        self.values = values
+
+    def pixel_index(self):
+        """ Flat indices of the stored pixels, in the order of values """
+        first = self.rows.astype(np.int64) * self.shape[1] + self.starts
+        run = np.repeat(np.arange(len(self.lengths)), self.lengths)
+        offset = np.arange(len(run)) - np.repeat(
+            np.cumsum(self.lengths) - self.lengths, self.lengths)
+        return first[run] + offset
+
+    def to_dense(self):
+        img = np.zeros(self.shape, dtype=np.uint8)
+        img.reshape(-1)[self.pixel_index()] = self.values
+        return img
+
+
+class RleCodec(Codec):
+    """
+    Only the pixels above threshold, as runs per row. IR marker frames are
+    almost all black, so this is a small fraction of the frame.
+    """
+    name = "rle"
+    HEADER = struct.Struct("<HHI")
+
+    def __init__(self, threshold=100):
+        self.threshold = threshold
+
+    def encode(self, img):
+        height, width = img.shape[0], img.shape[1]
+        flat = img.reshape(-1)
+        index = np.flatnonzero(flat > self.threshold)
+        # A run starts wherever the previous bright pixel is not the left
+        # neighbour in the same row
+        new_run = np.ones(len(index), dtype=bool)
+        new_run[1:] = (np.diff(index) != 1) | (index[1:] % width == 0)
+        first = np.flatnonzero(new_run)
+        lengths = np.diff(np.append(first, len(index)))
+        rows, starts = np.divmod(index[first], width)
+
+        payload = b"".join([
+            self.HEADER.pack(height, width, len(rows)),
+            rows.astype("<u2").tobytes(),
+            starts.astype("<u2").tobytes(),
+            lengths.astype("<u2").tobytes(),
+            flat[index].tobytes(),
+        ])
+        return payload, dict(shape=img.shape, threshold=self.threshold)
+
+    def decode_sparse(self, payload):
+        height, width, count = self.HEADER.unpack_from(payload)
+        runs = np.frombuffer(
+            payload, dtype="<u2", count=3 * count, offset=self.HEADER.size)
+        rows, starts, lengths = runs.reshape(3, count).astype(np.int64)
+        values = np.frombuffer(
+            payload, dtype=np.uint8, offset=self.HEADER.size + runs.nbytes)
+        return SparseFrame((height, width), rows, starts, lengths, values)
+
+    def decode(self, payload, meta):
+        return self.decode_sparse(payload).to_dense()
+
+
+class TileCodec(Codec):
+    """
+    Fixed size tiles holding at least one pixel above threshold, sent whole
+    so blobs can be re-detected offline with other settings.
+    """
+    name = "tiles"
+    HEADER = struct.Struct("<HHHI")
+
+    def __init__(self, threshold=100, size=32):
+        self.threshold = threshold
+        self.size = size
+
+    def encode(self, img):
+        height, width = img.shape[0], img.shape[1]
+        size = self.size
+        pad_h, pad_w = -height % size, -width % size
+        padded = np.pad(img, ((0, pad_h), (0, pad_w))) if pad_h or pad_w else img
+        tiles = padded.reshape(
+            padded.shape[0] // size, size, padded.shape[1] // size, size)
+        bright = tiles.max(axis=(1, 3)) > self.threshold
+        tile_y, tile_x = np.nonzero(bright)
+
+        payload = b"".join([
+            self.HEADER.pack(height, width, size, len(tile_y)),
+            tile_y.astype("<u2").tobytes(),
+            tile_x.astype("<u2").tobytes(),
+            tiles[tile_y, :, tile_x, :].tobytes(),
+        ])
+        return payload, dict(shape=img.shape, threshold=self.threshold)
+
+    def decode_tiles(self, payload):
+        """ Frame shape, tile size, tile (y, x) indices and tile pixels """
+        height, width, size, count = self.HEADER.unpack_from(payload)
+        index = np.frombuffer(
+            payload, dtype="<u2", count=2 * count, offset=self.HEADER.size)
+        pixels = np.frombuffer(
+            payload, dtype=np.uint8, offset=self.HEADER.size + index.nbytes)
+        tile_y, tile_x = index.reshape(2, count)
+        return (height, width), size, tile_y, tile_x, pixels.reshape(count, size, size)
+
+    def decode_sparse(self, payload):
+        shape, size, tile_y, tile_x, pixels = self.decode_tiles(payload)
+        # Keep the tiles as one run per tile row
+        count = len(tile_y)
+        line = np.arange(size)
+        rows = (tile_y[:, None].astype(np.int64) * size + line).reshape(-1)
+        starts = np.repeat(tile_x.astype(np.int64) * size, size)
+        lengths = np.full(count * size, size)
+        # Tiles of the padded border can stick out of the frame
+        lengths = np.minimum(lengths, shape[1] - starts)
+        inside = rows < shape[0]
+        values = pixels.reshape(count * size, size)
+        values = np.concatenate([
+            v[:n] for v, n in zip(values[inside], lengths[inside])
+        ]) if count else np.empty(0, dtype=np.uint8)
+        return SparseFrame(shape, rows[inside], starts[inside], lengths[inside], values)
+
+    def decode(self, payload, meta):
+        shape, size, tile_y, tile_x, pixels = self.decode_tiles(payload)
+        img = np.zeros(
+            (-(-shape[0] // size) * size, -(-shape[1] // size) * size),
+            dtype=np.uint8,
+        )
+        tiles = img.reshape(img.shape[0] // size, size, img.shape[1] // size, size)
+        tiles[tile_y, :, tile_x, :] = pixels
+        return img[:shape[0], :shape[1]]
+
+
+CODECS = {}
+
+def register_codec(codec_class):
+    """ Make a codec available by its name on both ends """
+    CODECS[codec_class.name] = codec_class
+    return codec_class
+
+for codec_class in (RawCodec, JpegCodec, PngCodec, ZlibCodec, RleCodec, TileCodec):
+    register_codec(codec_class)
+if lz4 is not None:
+    register_codec(Lz4Codec)
+if zstandard is not None:
+    register_codec(ZstdCodec)
+
+
+def create_codec(name, **params):
+    if name not in CODECS:
+        raise ValueError(
+            f"Unknown codec {name}, available codecs are {list(CODECS)}")
+    return CODECS[name](**params)
+
+# Decoders don't need the encoding parameters, one of each is enough per
+# thread: decompressor objects (zstd) must not be shared between threads
+_decoders = threading.local()
+
+def _decoder(name):
+    decoders = getattr(_decoders, "codecs", None)
+    if decoders is None:
+        decoders = _decoders.codecs = {}
+    if name not in decoders:
+        decoders[name] = create_codec(name)
+    return decoders[name]
+
+def decode_frame(meta, payload):
+    """ Decode a received frame with the codec named in its metadata """
+    # Senders from before the codecs were added only sent jpgs
+    return _decoder(meta.get("codec", "jpeg")).decode(payload, meta)
+
+def decode_sparse(meta, payload):
+    """ 
+    SparseFrame of a frame sent with a sparse codec (rle, tiles), None for
+    the dense codecs
+    """
+    decoder = _decoder(meta.get("codec", "jpeg"))
+    if not hasattr(decoder, "decode_sparse"):
+        return None
+    return decoder.decode_sparse(payload)
+
+def benchmark_codecs(frames, codecs):
+    """
+    Encode and decode every frame with every codec, returns a dict of
+    codec name -> mean encode time, decode time (s) and bytes per frame
+    """
+    results = {}
+    for codec in codecs:
+        encode_t, decode_t, size = 0.0, 0.0, 0
+        for frame in frames:
+            start = time.perf_counter()
+            payload, meta = codec.encode(frame)
+            encode_t += time.perf_counter() - start
+            start = time.perf_counter()
+            codec.decode(payload, meta)
+            decode_t += time.perf_counter() - start
+            size += len(payload)
+        results[codec.name] = (
+            encode_t / len(frames),
+            decode_t / len(frames),
+            size / len(frames),
+        )
+    return results
+
+def select_codec(frames, codecs, budget):
+    """
+    Smallest output among the codecs encoding a frame within budget seconds,
+    raw if none of them does
+    """
+    results = benchmark_codecs(frames, codecs)
+    fitting = [c for c in codecs if results[c.name][0] <= budget]
+    if not fitting:
+        return RawCodec()
+    return min(fitting, key=lambda c: results[c.name][2])
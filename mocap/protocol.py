@@ -0,0 +1,67 @@
+"""
+Binary messages shared by the camera nodes and the server.
+
+A detection record is a fixed header followed by one packed entry per
+marker, all little-endian:
+
+    seq      uint64   frame sequence number on the camera
+    cam_ts   int64    camera timestamp
+    grab_ts  int64    host wall clock time of the grab in ns
+    count    uint16   number of markers
+    flags    uint16   FLAG_NORMALIZED or 0, other bits reserved
+    count x (x, y, r) float32, or (x, y, r, nx, ny) with FLAG_NORMALIZED
+
+nx, ny are the undistorted normalized image coordinates of the centroid.
+"""
+from collections import namedtuple
+import struct
+
+import numpy as np
+
+DETECTION_HEADER = struct.Struct("<QqqHH")
+
+# Markers carry normalized coordinates next to the pixel ones
+FLAG_NORMALIZED = 1
+
+MARKER_RECORD = np.dtype([
+    ("x", "<f4"),
+    ("y", "<f4"),
+    ("r", "<f4"),
+])
+
+MARKER_RECORD_NORMALIZED = np.dtype(MARKER_RECORD.descr + [
+    ("nx", "<f4"),
+    ("ny", "<f4"),
+])
+
+DetectionRecord = namedtuple(
+    "DetectionRecord", ["seq", "cam_ts", "grab_ts", "markers"])
+
+
+def pack_detections(seq, cam_ts, grab_ts, markers):
+    """ 
+    Pack markers (anything with x, y, r fields) into a detection record,
+    nx, ny are sent too if the markers have them
+    """
+    if "nx" in markers.dtype.names:
+        dtype, flags = MARKER_RECORD_NORMALIZED, FLAG_NORMALIZED
+    else:
+        dtype, flags = MARKER_RECORD, 0
+    record = np.empty(len(markers), dtype=dtype)
+    for name in dtype.names:
+        record[name] = markers[name]
+    header = DETECTION_HEADER.pack(seq, cam_ts, grab_ts, len(markers), flags)
+
+    return header + record.tobytes()
+
+def unpack_detections(buffer):
+    """ Decode a detection record, markers are a view of the buffer """
+    seq, cam_ts, grab_ts, count, flags = DETECTION_HEADER.unpack_from(buffer)
+    markers = np.frombuffer(
+        buffer,
+        dtype=MARKER_RECORD_NORMALIZED if flags & FLAG_NORMALIZED else MARKER_RECORD,
+        count=count,
+        offset=DETECTION_HEADER.size,
+    )
+
+    return DetectionRecord(seq, cam_ts, grab_ts, markers)
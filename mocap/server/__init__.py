@@ -1,2 +1,3 @@
-from .tools import VideoStreamSubscriber
-from .server import Server
\ No newline at end of file
+from .tools import VideoStreamSubscriber, DetectionSubscriber
+from .server import Server
+from .sync import FrameSynchronizer
\ No newline at end of file
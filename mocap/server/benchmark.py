@@ -0,0 +1,223 @@
+"""
+Throughput of the server side reconstruction stages on a synthetic scene,
+cameras on a circle around random markers, so no recording is needed.
+
+    python -m mocap.server.benchmark --cameras 8 --markers 300
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import cv2
+
+from .triangulation import triangulate
+from .correspondence import EpipolarMatcher
+from .decode_pool import DecodePool
+from ..tracking import MarkerTracker
+from ..codecs import create_codec
+
+# Focal length (px) the normalized coordinates are converted with
+FOCAL = 1000.0
+
+
+def look_at(position, target=(0.0, 0.0, 0.0), up=(0.0, 0.0, 1.0)):
+    """ [R|t] of a camera at position looking at target """
+    forward = np.asarray(target, dtype=np.float64) - position
+    forward /= np.linalg.norm(forward)
+    right = np.cross(forward, up)
+    right /= np.linalg.norm(right)
+    down = np.cross(forward, right)
+    rotation = np.stack([right, down, forward])
+
+    return np.hstack([rotation, (-rotation @ position)[:, None]])
+
+def make_cameras(num_cameras, radius=5.0, height=2.0):
+    """ (C, 3, 4) projections of cameras evenly spread on a circle """
+    angles = np.linspace(0, 2 * np.pi, num_cameras, endpoint=False)
+    return np.stack([
+        look_at(np.array([radius * np.cos(a), radius * np.sin(a), height]))
+        for a in angles
+    ])
+
+def make_observations(projections, points_3d, noise, outliers, missing, rng):
+    """
+    Normalized observations of the points, with noise (px) on all of
+    them, a fraction replaced by outliers and a fraction left out
+    """
+    homogeneous = np.concatenate([points_3d, np.ones((len(points_3d), 1))], axis=1)
+    projected = np.einsum("cij,mj->mci", projections, homogeneous)
+    points = projected[..., :2] / projected[..., 2:]
+    points += rng.normal(0, noise / FOCAL, points.shape)
+
+    shape = points.shape[:2]
+    wrong = rng.random(shape) < outliers
+    points[wrong] += rng.uniform(-0.2, 0.2, (np.count_nonzero(wrong), 2))
+    points[rng.random(shape) < missing] = np.nan
+
+    return points
+
+def report(name, times, items):
+    median = np.median(times)
+    print(
+        f"{name:<24} median {median*1e3:8.3f} ms"
+        f"  p95 {np.percentile(times, 95)*1e3:8.3f} ms"
+        f"  max rate {1/median:9.1f} fps"
+        f"  {items/median:11.0f} markers/s"
+    )
+
+def bench_triangulation(args, rng):
+    projections = make_cameras(args.cameras)
+    frames = []
+    for _ in range(args.frames):
+        truth = rng.uniform(-1, 1, (args.markers, 3))
+        frames.append((truth, make_observations(
+            projections, truth, args.noise, args.outliers, args.missing, rng)))
+
+    threshold = args.threshold / FOCAL
+    times, errors, lost = [], [], 0
+    for truth, points in frames:
+        start = time.perf_counter()
+        result = triangulate(projections, points, threshold)
+        times.append(time.perf_counter() - start)
+        solved = ~np.isnan(result.points[:, 0])
+        lost += np.count_nonzero(~solved)
+        errors.append(np.linalg.norm(result.points[solved] - truth[solved], axis=1))
+
+    report("triangulate", np.array(times), args.markers)
+    errors = np.concatenate(errors)
+    print(
+        f"3d error median {np.median(errors)*1e3:.3f} mm"
+        f"  p99 {np.percentile(errors, 99)*1e3:.3f} mm"
+        f"  unsolved {lost / (args.markers * args.frames):.2%}"
+        f" (scene units are m)"
+    )
+
+def bench_matching(args, rng):
+    """ Matching of shuffled per-camera detections, then triangulation """
+    projections = make_cameras(args.cameras)
+    matcher = EpipolarMatcher(projections, args.tolerance / FOCAL)
+    frames = []
+    for _ in range(args.frames):
+        truth = rng.uniform(-1, 1, (args.match_markers, 3))
+        points = make_observations(
+            projections, truth, args.noise, 0.0, args.missing, rng)
+        views, ids = [], []
+        for cam in range(args.cameras):
+            seen = rng.permutation(np.flatnonzero(~np.isnan(points[:, cam, 0])))
+            views.append(points[seen, cam])
+            ids.append(seen)
+        frames.append((views, ids))
+
+    match_times, total_times, groups, pure = [], [], 0, 0
+    for views, ids in frames:
+        start = time.perf_counter()
+        matches = matcher.match(views)
+        match_times.append(time.perf_counter() - start)
+        triangulate(projections, matches.points, args.threshold / FOCAL)
+        total_times.append(time.perf_counter() - start)
+
+        for row in matches.index:
+            # Every view of a group has to be the same marker
+            pure += len({ids[cam][i] for cam, i in enumerate(row) if i >= 0}) == 1
+        groups += len(matches.index)
+
+    report("match", np.array(match_times), args.match_markers)
+    report("match + triangulate", np.array(total_times), args.match_markers)
+    print(
+        f"groups per frame {groups / args.frames:.1f} of {args.match_markers}"
+        f" markers, {pure / max(groups, 1):.2%} without a wrong view"
+    )
+
+def bench_tracking(args, rng):
+    """ 3D tracks of markers swinging around at up to a few m/s """
+    count, dt = args.track_markers, 1 / args.fps
+    centres = rng.uniform(-1, 1, (count, 3))
+    amplitude = rng.uniform(0.05, 0.3, (count, 3))
+    omega = rng.uniform(0.5, 2 * np.pi, (count, 3))
+    phase = rng.uniform(0, 2 * np.pi, (count, 3))
+    noise = args.noise / FOCAL * 3.0
+
+    tracker = MarkerTracker(
+        dim=3, dt=dt, process_noise=1e3, measurement_noise=noise**2)
+    times, switches, births, last_id = [], 0, 0, np.full(count, -1)
+    for frame in range(args.frames):
+        positions = centres + amplitude * np.sin(omega * frame * dt + phase)
+        seen = np.flatnonzero(rng.random(count) >= args.missing / 10)
+        detections = positions[seen] + rng.normal(0, noise, (len(seen), 3))
+        order = rng.permutation(len(seen))
+
+        start = time.perf_counter()
+        update = tracker.update(detections[order])
+        times.append(time.perf_counter() - start)
+
+        ids = np.empty(len(seen), dtype=np.int64)
+        ids[order] = update.ids
+        if frame:
+            births += len(update.births)
+            switches += np.count_nonzero((last_id[seen] >= 0) & (last_id[seen] != ids))
+        last_id[seen] = ids
+
+    report("track", np.array(times), count)
+    print(
+        f"id switches {switches} births after the first frame {births}"
+        f" over {args.frames} frames of {count} markers"
+    )
+
+def bench_decode(args, rng):
+    """ Decoded frames/s of jpegs from several cameras by pool size """
+    frames = []
+    codec = create_codec("jpeg")
+    for _ in range(16):
+        image = np.zeros((1200, 1920), dtype=np.uint8)
+        for x, y in rng.uniform((0, 0), (1920, 1200), (args.match_markers, 2)):
+            cv2.circle(image, (int(x), int(y)), 8, 255, -1)
+        image = cv2.add(image, rng.integers(0, 20, image.shape, dtype=np.uint8))
+        payload, meta = codec.encode(image)
+        frames.append((dict(meta, codec="jpeg"), payload))
+
+    messages = [
+        (dict(md, msg=f"cam{i % args.cameras}"), payload)
+        for i, (md, payload) in enumerate(frames * 8)
+    ]
+    for workers in sorted({1, 2, 4, os.cpu_count()}):
+        pool = DecodePool(workers)
+        start = time.perf_counter()
+        for md, payload in messages:
+            pool.submit(md, payload)
+            pool.ready()
+        pool.drain()
+        elapsed = time.perf_counter() - start
+        pool.close()
+        print(
+            f"decode {workers:>2} workers {len(messages) / elapsed:8.1f} frames/s"
+            f"  ({args.cameras} cameras, 1920x1200 jpeg)"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cameras", type=int, default=8)
+    parser.add_argument("--markers", type=int, default=300)
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--noise", type=float, default=0.5, help="px")
+    parser.add_argument("--outliers", type=float, default=0.02, help="fraction of observations")
+    parser.add_argument("--missing", type=float, default=0.2, help="fraction of observations")
+    parser.add_argument("--threshold", type=float, default=4.0, help="reprojection error, px")
+    parser.add_argument("--match-markers", type=int, default=40, help="markers in the matching scene")
+    parser.add_argument("--tolerance", type=float, default=2.0, help="epipolar distance, px")
+    parser.add_argument("--track-markers", type=int, default=100, help="markers in the tracking scene")
+    parser.add_argument("--fps", type=float, default=120)
+    parser.add_argument("--decode", action="store_true", help="benchmark the decode pool")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    bench_triangulation(args, rng)
+    bench_matching(args, rng)
+    bench_tracking(args, rng)
+    if args.decode:
+        bench_decode(args, rng)
+
+
+if __name__ == "__main__":
+    main()
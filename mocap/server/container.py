@@ -0,0 +1,218 @@
+"""
+Append-only recording of the frames of one camera.
+
+A camera dir holds the encoded frames back to back in chunk files of
+about chunk_size bytes (chunk_00000.dat, ...), a fixed size record per
+frame in index.bin and manifest.json with the codec table. The index
+points to a codec table entry, the codec name and the metadata a frame
+needs to be decoded, so frames sent with the same settings share one.
+
+Frames are only ever appended, the data of a batch before its index
+records, so after a crash the index is valid up to its last whole record
+pointing at data that made it to disk. The manifest is replaced
+atomically (written to a temp file, then renamed) and marked finalized
+on close.
+
+    python -m mocap.server.container test_data/<session>
+"""
+from pathlib import Path
+import argparse
+import json
+import os
+
+import numpy as np
+
+INDEX_RECORD = np.dtype([
+    ("seq", "<u8"),
+    ("cam_ts", "<i8"),
+    ("grab_ts", "<i8"),
+    ("recv_ts", "<i8"),
+    ("chunk", "<u4"),
+    ("length", "<u4"),
+    ("offset", "<u8"),
+    ("codec", "<u2"),
+])
+
+# Metadata kept in the index records, not in the codec table
+RECORD_FIELDS = ("msg", "seq", "cam_ts", "grab_ts", "recv_ts")
+
+
+def chunk_name(chunk):
+    return f"chunk_{chunk:05d}.dat"
+
+def write_manifest(path, manifest):
+    """ Replace the manifest atomically """
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ContainerWriter():
+    """ Appends frames of one camera to a container dir """
+    def __init__(self, path, camera, chunk_size=256 * 2**20, fsync=False):
+        self.path = Path(path)
+        if (self.path / "index.bin").exists():
+            raise FileExistsError(f"{self.path} already holds a recording")
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.chunk_size = chunk_size
+        # Sync the data to disk before its index records go out
+        self.fsync = fsync
+        self.manifest = dict(
+            version=1,
+            camera=camera,
+            chunk_size=chunk_size,
+            codecs=[],
+            frames=0,
+            finalized=False,
+        )
+        self.codecs = {}
+        self.chunk = 0
+        self.offset = 0
+        self.pending = []
+        self.data = open(self.path / chunk_name(self.chunk), "ab")
+        self.index = open(self.path / "index.bin", "ab")
+        write_manifest(self.path / "manifest.json", self.manifest)
+
+    def _codec(self, md):
+        """ Codec table entry of a frame, added (and saved) when new """
+        meta = {k: v for k, v in md.items() if k not in RECORD_FIELDS}
+        key = json.dumps(meta, sort_keys=True)
+        if key not in self.codecs:
+            self.codecs[key] = len(self.manifest["codecs"])
+            self.manifest["codecs"].append(meta)
+            # The index may only refer to entries on disk
+            write_manifest(self.path / "manifest.json", self.manifest)
+        return self.codecs[key]
+
+    def append(self, md, buffer):
+        """ Add a frame, on disk once flush() is called """
+        length = memoryview(buffer).nbytes
+        if self.offset and self.offset + length > self.chunk_size:
+            self._next_chunk()
+        self.data.write(buffer)
+        self.pending.append((
+            md.get("seq") or 0,
+            md.get("cam_ts") or 0,
+            md.get("grab_ts") or 0,
+            md.get("recv_ts") or 0,
+            self.chunk,
+            length,
+            self.offset,
+            self._codec(md),
+        ))
+        self.offset += length
+
+    def _next_chunk(self):
+        self._sync_data()
+        self.data.close()
+        self.chunk += 1
+        self.offset = 0
+        self.data = open(self.path / chunk_name(self.chunk), "ab")
+
+    def _sync_data(self):
+        self.data.flush()
+        if self.fsync:
+            os.fsync(self.data.fileno())
+
+    def flush(self):
+        """ Write the index records of the frames appended so far """
+        if not self.pending:
+            return
+        self._sync_data()
+        self.index.write(np.array(self.pending, dtype=INDEX_RECORD).tobytes())
+        self.index.flush()
+        if self.fsync:
+            os.fsync(self.index.fileno())
+        self.manifest["frames"] += len(self.pending)
+        self.pending = []
+
+    def close(self):
+        """ Flush and mark the recording finalized """
+        self.flush()
+        os.fsync(self.data.fileno())
+        os.fsync(self.index.fileno())
+        self.data.close()
+        self.index.close()
+        self.manifest["finalized"] = True
+        write_manifest(self.path / "manifest.json", self.manifest)
+
+
+class ContainerReader():
+    """
+    Frames of a container dir. An unfinalized (crashed) recording is read
+    up to its last complete frame.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / "manifest.json") as f:
+            self.manifest = json.load(f)
+        raw = (self.path / "index.bin").read_bytes()
+        # A torn last record is dropped
+        whole = len(raw) // INDEX_RECORD.itemsize * INDEX_RECORD.itemsize
+        self.index = np.frombuffer(raw[:whole], dtype=INDEX_RECORD)
+        if not self.manifest["finalized"]:
+            self.index = self.index[:self._valid_frames()]
+        self._chunks = {}
+
+    def _valid_frames(self):
+        """ Length of the index prefix with all its data on disk """
+        sizes = []
+        for chunk in range(int(self.index["chunk"].max(initial=0)) + 1):
+            path = self.path / chunk_name(chunk)
+            sizes.append(path.stat().st_size if path.exists() else 0)
+        sizes = np.array(sizes, dtype=np.uint64)
+        ok = (
+            (self.index["offset"] + self.index["length"] <= sizes[self.index["chunk"]]) &
+            (self.index["codec"] < len(self.manifest["codecs"]))
+        )
+        return len(ok) if ok.all() else int(np.argmin(ok))
+
+    def __len__(self):
+        return len(self.index)
+
+    def _chunk(self, chunk):
+        if chunk not in self._chunks:
+            path = self.path / chunk_name(chunk)
+            self._chunks[chunk] = np.memmap(path, dtype=np.uint8, mode="r")
+        return self._chunks[chunk]
+
+    def read(self, i):
+        """ (metadata, payload) of frame i, as they were received """
+        record = self.index[i]
+        md = dict(self.manifest["codecs"][record["codec"]])
+        md.update(
+            msg=self.manifest["camera"],
+            **{name: int(record[name]) for name in RECORD_FIELDS[1:]},
+        )
+        start = int(record["offset"])
+        payload = self._chunk(int(record["chunk"]))[start:start + int(record["length"])]
+        return md, payload
+
+    def frames(self):
+        for i in range(len(self)):
+            yield self.read(i)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("session", help="recording dir with a container per camera")
+    args = parser.parse_args()
+
+    for manifest in sorted(Path(args.session).glob("*/manifest.json")):
+        reader = ContainerReader(manifest.parent)
+        index = reader.index
+        span = (index["recv_ts"][-1] - index["recv_ts"][0]) * 1e-9 if len(index) else 0.0
+        print(
+            f"{reader.manifest['camera']:<16} {len(reader):8d} frames"
+            f" {int(index['length'].sum()) / 2**20:10.1f} MB"
+            f" {span:8.1f} s"
+            f" codecs {[codec.get('codec') for codec in reader.manifest['codecs']]}"
+            f"{'' if reader.manifest['finalized'] else ' (not finalized)'}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import os
+
+from ..codecs import decode_frame
+
+
+class DecodePool():
+    """
+    Decodes received frames on a thread pool, OpenCV releases the GIL so
+    the decoders run on separate cores.
+
+    Frames of one camera come back in the order they were submitted, a
+    slow frame holds back the later ones of its camera only. At most
+    max_pending frames per camera are in flight, submit() waits for the
+    oldest one beyond that.
+    """
+    def __init__(self, workers=None, max_pending=None, transform=None):
+        self.workers = workers or os.cpu_count()
+        self.max_pending = max_pending or 2 * self.workers
+        # Applied to the decoded image on the worker, e.g. a resize
+        self.transform = transform
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = {}
+        self.decoded = 0
+        self.waited = 0
+
+    def _decode(self, md, buffer):
+        image = decode_frame(md, buffer)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image
+
+    def submit(self, md, buffer):
+        pending = self.pending.setdefault(md["msg"], deque())
+        if len(pending) >= self.max_pending:
+            # Backpressure, the receive queues absorb or drop meanwhile
+            self.waited += 1
+            pending[0][1].result()
+        pending.append((md, self.pool.submit(self._decode, md, buffer)))
+
+    def ready(self):
+        """ (md, image) of the frames decoded so far, in order per camera """
+        frames = []
+        for pending in self.pending.values():
+            while pending and pending[0][1].done():
+                md, future = pending.popleft()
+                frames.append((md, future.result()))
+        self.decoded += len(frames)
+        return frames
+
+    def drain(self):
+        """ Wait for everything submitted, returns it like ready() """
+        for pending in self.pending.values():
+            for _, future in pending:
+                future.result()
+        return self.ready()
+
+    def depth(self):
+        """ Frames in flight per camera """
+        return {camera: len(pending) for camera, pending in self.pending.items()}
+
+    def stats(self):
+        return dict(
+            decoded=self.decoded,
+            queued=self.depth(),
+            # Submits that had to wait for a decoder
+            waited=self.waited,
+        )
+
+    def close(self):
+        self.pool.shutdown()
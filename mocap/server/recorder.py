@@ -0,0 +1,166 @@
+from pathlib import Path
+import threading
+import queue
+import json
+import time
+
+from .container import ContainerWriter
+
+# File extension of the frames of a codec, the rest only make sense
+# together with their metadata from the index
+EXTENSIONS = {"jpeg": "jpg", "png": "png"}
+
+
+class Recorder():
+    """
+    Writes received frames to disk exactly as they arrived, no decoding or
+    re-encoding, from a writer thread.
+
+    record() only puts the frame on a bounded queue, it never waits: with
+    the queue full the frame is dropped and counted, so a slow disk shows
+    up in stats() instead of stalling reception. The writer takes up to
+    batch frames at a time and appends the metadata of a whole batch to
+    the index (frames.jsonl) of every camera in one write.
+
+    With container set the frames of a camera go to one append-only
+    container (see container.py) with chunks of chunk_size bytes instead
+    of a file each.
+
+    A batch that fails to write (disk full, permissions, ...) is reported,
+    counted as failed in stats() and the writer carries on with the next.
+    """
+    def __init__(self, data_dir, max_queue=256, batch=32, container=False,
+                 chunk_size=256 * 2**20):
+        self.data_dir = Path(data_dir)
+        self.batch = batch
+        self.container = container
+        self.chunk_size = chunk_size
+        self.writers = {}
+        self.queue = queue.Queue(max_queue)
+        self.frames = {}
+        self.written = 0
+        self.bytes = 0
+        self.dropped = 0
+        # Frames of the batches that failed to write
+        self.failed = 0
+        self.errors = 0
+        self.last_error = None
+        self.batches = 0
+        self.max_queued = 0
+        self.write_time = 0.0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def record(self, md, buffer):
+        """ Queue a received frame for writing, False if it was dropped """
+        try:
+            self.queue.put_nowait((md, buffer))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.max_queued = max(self.max_queued, self.queue.qsize())
+        return True
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            # None asks the writer to stop once everything before it is written
+            done = batch[-1] is None
+            if done:
+                batch.pop()
+            if batch:
+                start = time.perf_counter()
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    # Keep taking frames, the sink may recover (disk space
+                    # freed) and the queue must not fill up behind a dead writer
+                    self.errors += 1
+                    self.failed += len(batch)
+                    self.last_error = repr(e)
+                    print(f"Recorder: writing {len(batch)} frames failed: {e!r}")
+                self.write_time += time.perf_counter() - start
+            if done:
+                break
+
+    def _write(self, batch):
+        if self.container:
+            self._append(batch)
+            return
+        index = {}
+        for md, buffer in batch:
+            msg = md["msg"]
+            cnt = self.frames.get(msg, 0)
+            self.frames[msg] = cnt + 1
+            name = f"frame_{cnt}.{EXTENSIONS.get(md.get('codec', 'jpeg'), 'bin')}"
+            cam_dir = self.data_dir / msg
+            if cnt == 0:
+                cam_dir.mkdir(parents=True, exist_ok=True)
+            with open(cam_dir / name, "wb") as f:
+                size = f.write(buffer)
+            self.bytes += size
+            index.setdefault(msg, []).append(
+                json.dumps(dict(md, file=name)))
+
+        for msg, lines in index.items():
+            with open(self.data_dir / msg / "frames.jsonl", "a") as f:
+                f.write("\n".join(lines) + "\n")
+        self.written += len(batch)
+        self.batches += 1
+
+    def _append(self, batch):
+        for md, buffer in batch:
+            msg = md["msg"]
+            if msg not in self.writers:
+                self.writers[msg] = ContainerWriter(
+                    self.data_dir / msg, msg, self.chunk_size)
+            self.writers[msg].append(md, buffer)
+            self.bytes += memoryview(buffer).nbytes
+        # One data and one index write per camera and batch
+        for writer in self.writers.values():
+            writer.flush()
+        self.written += len(batch)
+        self.batches += 1
+
+    def stats(self):
+        return dict(
+            written=self.written,
+            bytes=self.bytes,
+            dropped=self.dropped,
+            failed=self.failed,
+            errors=self.errors,
+            last_error=self.last_error,
+            queued=self.queue.qsize(),
+            max_queued=self.max_queued,
+            batches=self.batches,
+            # Time the writer spent writing, of the session length
+            write_time=round(self.write_time, 3),
+        )
+
+    def close(self, timeout=10.0):
+        """
+        Write everything queued and stop the writer, gives up after timeout
+        seconds so a stuck sink can't hang the shutdown
+        """
+        if self._thread.is_alive():
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+        if self._thread.is_alive():
+            print(f"Recorder: writer still busy after {timeout} s, "
+                  f"{self.queue.qsize()} frames not written")
+            return
+        for writer in self.writers.values():
+            try:
+                writer.close()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = repr(e)
+                print(f"Recorder: closing {writer.path} failed: {e!r}")
@@ -2,12 +2,15 @@ from pathlib import Path
 import threading
 import datetime
 import cv2
-import numpy as np
 
 from .tools import (
     read_config,
     VideoStreamSubscriber,
+    DetectionSubscriber,
 )
+from .sync import FrameSynchronizer
+from .decode_pool import DecodePool
+from .recorder import Recorder
 
 class Server():
     def __init__(
@@ -19,8 +22,36 @@ class Server():
         self.config = read_config(config_file)
         self.publishers = self.config["PUBLISHERS"]
         self.data_dir = self.config["DATA_DIR"]
+        self.show = self.config.get("SHOW", True)
         self.exp_dir = self._create_dirs()
-        self.stream = VideoStreamSubscriber(self.publishers, "5555")
+        queue_config = self.config.get("QUEUE", {})
+        self.stream = VideoStreamSubscriber(
+            self.publishers, 
+            str(self.config.get("IMG_PORT", 5555)),
+            queue_config.get("MAXLEN", 8),
+            queue_config.get("POLICY", "drop-oldest"),
+        )
+        self.detection_stream = DetectionSubscriber(
+            self.publishers, 
+            str(self.config.get("DET_PORT", 5556)),
+            queue_config.get("MAXLEN", 8),
+            queue_config.get("POLICY", "drop-oldest"),
+        )
+
+        sync_config = self.config.get("SYNC", {})
+        self.detection_sync = FrameSynchronizer(
+            self.publishers,
+            int(sync_config.get("TOLERANCE_MS", 4) * 1e6),
+            int(sync_config.get("DEADLINE_MS", 50) * 1e6),
+            sync_config.get("MAX_PENDING", 64),
+        )
+
+        # Frames are decoded only to be shown, resized on the decoders
+        self.decoder = DecodePool(
+            self.config.get("DECODE_WORKERS"),
+            self.config.get("DECODE_QUEUE"),
+            transform=lambda image: cv2.resize(image, (255, 255)),
+        )
 
         self._start_reciving = threading.Event()
         self._stop_threads = threading.Event()
@@ -36,21 +67,69 @@ class Server():
                     
 
     def _save_thread(self, stream, data_dir):
-        cam_cnt = {}
+        self.recorder = None
+        if self.config.get("RECORD", True):
+            self.recorder = Recorder(
+                data_dir,
+                self.config.get("RECORD_QUEUE", 256),
+                self.config.get("RECORD_BATCH", 32),
+                self.config.get("RECORD_FORMAT", "container") == "container",
+                self.config.get("RECORD_CHUNK_MB", 256) * 2**20,
+            )
         while True:
             if self._stop_threads.is_set():
                 break
-            msg, jpg_buffer = stream.receive()
-            cnt = cam_cnt.setdefault(msg, 0)
-            image = cv2.imdecode(np.frombuffer(jpg_buffer, dtype='uint8'), -1)
-            img_name = data_dir / f"{msg}/frame_{cnt}.jpg"
-            print(img_name)
-            #cv2.imwrite(str(img_name), image)
-            cam_cnt[msg] += 1
-            cv2.imshow(msg, cv2.resize(image, (255, 255))) 
-            cv2.waitKey(1)
+            try:
+                batch = stream.receive_batch(timeout=0.1)
+            except TimeoutError:
+                batch = []
+            for md, buffer in batch:
+                if self.recorder is not None:
+                    # The received bytes as they are, written behind
+                    self.recorder.record(md, buffer)
+                if self.show:
+                    # Dense frames are only rebuilt for display
+                    self.decoder.submit(md, buffer)
+            if self.show:
+                self._show_frames(self.decoder.ready())
 
         stream.close()
+        if self.recorder is not None:
+            self.recorder.close()
+            print("Record stats:", self.recorder.stats())
+        if self.show:
+            self._show_frames(self.decoder.drain())
+            print("Decode stats:", self.decoder.stats())
+        print("Receive stats:", stream.stats())
+
+    def _show_frames(self, frames):
+        for md, image in frames:
+            cv2.imshow(md["msg"], image) 
+        if frames:
+            cv2.waitKey(1)
+
+    def print_detections(self):
+        """ Print the markers received from every camera """
+        while not self._stop_threads.is_set():
+            msg, record = self.detection_stream.receive()
+            print(msg, record.seq, len(record.markers))
+
+    def detection_sets(self):
+        """ 
+        Generator of FrameSets with the DetectionRecord of every camera
+        taken at the same instant, incomplete once past SYNC.DEADLINE_MS
+        """
+        sync = self.detection_sync
+        timeout = sync.deadline * 1e-9
+        while not self._stop_threads.is_set():
+            try:
+                msg, record = self.detection_stream.receive(timeout)
+            except TimeoutError:
+                yield from sync.poll()
+                continue
+            yield from sync.push(msg, record.grab_ts, record)
+        yield from sync.flush()
+        print("Sync stats:", sync.stats())
 
     def _create_dirs(self):
         root = Path(self.data_dir)
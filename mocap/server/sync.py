@@ -0,0 +1,134 @@
+"""
+Grouping of the per-camera streams into sets of frames taken at the same
+instant.
+
+Frames are matched on grab_ts, the wall clock of the camera host at grab
+time, so the camera hosts' clocks have to be synchronized (NTP/PTP) to
+well within the tolerance.
+"""
+from collections import namedtuple
+import time
+
+# Frames of one instant, items is camera -> item, cameras that didn't
+# deliver in time are missing from it
+FrameSet = namedtuple("FrameSet", ["timestamp", "items", "complete"])
+
+
+class _PendingSet():
+    def __init__(self, timestamp, created):
+        self.timestamp = timestamp
+        self.created = created
+        self.items = {}
+
+
+class FrameSynchronizer():
+    """
+    Collects frames from the cameras into FrameSets.
+
+    A frame joins the waiting set closest in time within tolerance (ns)
+    that has nothing from its camera yet, otherwise it starts a new set.
+    A set is emitted once every camera delivered, or deadline (ns) after
+    it was started. Every camera sends in order, so a complete set also
+    releases all older ones, sets come out in timestamp order. At most
+    max_pending sets wait, the oldest is emitted early beyond that.
+    Frames no newer than the last emitted set are late and dropped.
+    """
+    def __init__(self, cameras, tolerance, deadline, max_pending=64):
+        self.cameras = list(cameras)
+        self.tolerance = tolerance
+        self.deadline = deadline
+        self.max_pending = max_pending
+        # Waiting sets, oldest first
+        self.pending = []
+        self.last_emitted = None
+        self.received = dict.fromkeys(self.cameras, 0)
+        self.late = dict.fromkeys(self.cameras, 0)
+        self.missing = dict.fromkeys(self.cameras, 0)
+        self.complete = 0
+        self.incomplete = 0
+        self.unknown = 0
+
+    def push(self, camera, timestamp, item, now=None):
+        """ Add a frame, returns the FrameSets that are ready """
+        now = time.monotonic_ns() if now is None else now
+        if camera not in self.received:
+            # Not one of the cameras a set is made of
+            self.unknown += 1
+            return self.poll(now)
+        self.received[camera] += 1
+        if (self.last_emitted is not None and
+                timestamp <= self.last_emitted + self.tolerance):
+            # Its set is gone already
+            self.late[camera] += 1
+            return self.poll(now)
+
+        best = None
+        for index, pending in enumerate(self.pending):
+            offset = abs(pending.timestamp - timestamp)
+            if offset <= self.tolerance and camera not in pending.items:
+                if best is None or offset < abs(self.pending[best].timestamp - timestamp):
+                    best = index
+        if best is None:
+            best = self._insert(_PendingSet(timestamp, now))
+        self.pending[best].items[camera] = item
+
+        ready = []
+        if len(self.pending[best].items) == len(self.cameras):
+            # Everything older is not going to get more frames
+            ready = self._emit(best + 1)
+        elif len(self.pending) > self.max_pending:
+            ready = self._emit(1)
+
+        return ready + self.poll(now)
+
+    def poll(self, now=None):
+        """ Sets past their deadline, with older ones before them """
+        now = time.monotonic_ns() if now is None else now
+        expired = [
+            index for index, pending in enumerate(self.pending)
+            if now - pending.created >= self.deadline
+        ]
+        if not expired:
+            return []
+        return self._emit(expired[-1] + 1)
+
+    def flush(self):
+        """ Everything still waiting """
+        return self._emit(len(self.pending))
+
+    def _insert(self, pending):
+        index = len(self.pending)
+        while index and self.pending[index - 1].timestamp > pending.timestamp:
+            index -= 1
+        self.pending.insert(index, pending)
+        return index
+
+    def _emit(self, count):
+        """ The count oldest sets """
+        ready, self.pending = self.pending[:count], self.pending[count:]
+        sets = []
+        for pending in ready:
+            complete = len(pending.items) == len(self.cameras)
+            if complete:
+                self.complete += 1
+            else:
+                self.incomplete += 1
+                for camera in self.cameras:
+                    if camera not in pending.items:
+                        self.missing[camera] += 1
+            self.last_emitted = pending.timestamp
+            sets.append(FrameSet(pending.timestamp, pending.items, complete))
+        return sets
+
+    def stats(self):
+        return dict(
+            complete=self.complete,
+            incomplete=self.incomplete,
+            pending=len(self.pending),
+            received=dict(self.received),
+            # Frames arriving after their set was emitted
+            late=dict(self.late),
+            # Sets emitted without a frame of the camera
+            missing=dict(self.missing),
+            unknown=self.unknown,
+        )
@@ -5,8 +5,10 @@ import traceback
 import cv2
 import numpy as np
 import threading
+from collections import deque
 
 from .imagezmq import ImageHub
+from ..protocol import unpack_detections
 import time
 import yaml
 import os
@@ -20,35 +22,132 @@ def read_config(config_file):
 
 # Helper class implementing an IO deamon thread
 class VideoStreamSubscriber:
+    """
+    Receives (metadata, buffer) pairs from all publishers on a background
+    thread into a bounded queue per publisher (md["msg"]), so a fast
+    camera can't push out the frames of the others.
 
-    def __init__(self, hostnames, port):
+    When a queue is full the policy decides: "drop-oldest" makes room by
+    dropping the oldest queued frame, "drop-newest" drops the arriving one
+    and "block" stops receiving until there is room, the frames then pile
+    up in the zmq socket and are dropped there past its high water mark.
+    """
+    POLICIES = ("drop-oldest", "drop-newest", "block")
+
+    def __init__(self, hostnames, port, maxlen=8, policy="drop-oldest"):
+        if policy not in self.POLICIES:
+            raise ValueError(
+                f"Unknown queue policy {policy}, available are {self.POLICIES}")
         self.hostnames = hostnames
         self.port = port
+        self.maxlen = maxlen
+        self.policy = policy
         self._stop = False
-        self._data_ready = threading.Event()
+        self._queues = {}
+        self._counters = {}
+        # Publishers in the order receive() serves them
+        self._order = deque()
+        self._cond = threading.Condition()
         self._thread = threading.Thread(target=self._run, args=())
         self._thread.daemon = True
         self._thread.start()
 
-    def receive(self, timeout=15.0):
-        flag = self._data_ready.wait(timeout=timeout)
-        if not flag:
+    def _wait_ready(self, timeout):
+        ready = self._cond.wait_for(
+            lambda: any(self._queues.values()), timeout=timeout)
+        if not ready:
             raise TimeoutError(
                 "Timeout while reading from subscriber")
-        self._data_ready.clear()
-        return self._data
+
+    def _pop(self, pub):
+        item = self._queues[pub].popleft()
+        self._counters[pub]["delivered"] += 1
+        return item
+
+    def receive(self, timeout=15.0):
+        """ Next (metadata, buffer) pair, the sender is md["msg"] """
+        with self._cond:
+            self._wait_ready(timeout)
+            # Round robin over the publishers with frames waiting
+            while not self._queues[self._order[0]]:
+                self._order.rotate(-1)
+            pub = self._order[0]
+            self._order.rotate(-1)
+            item = self._pop(pub)
+            self._cond.notify_all()
+        return item
+
+    def receive_batch(self, timeout=15.0):
+        """ 
+        Everything waiting, oldest first per publisher, as a list of
+        (metadata, buffer) pairs. Waits for at least one frame.
+        """
+        with self._cond:
+            self._wait_ready(timeout)
+            batch = [
+                self._pop(pub)
+                for pub in self._order
+                for _ in range(len(self._queues[pub]))
+            ]
+            self._cond.notify_all()
+        return batch
+
+    def stats(self):
+        """ Received, delivered, dropped and queued frames per publisher """
+        with self._cond:
+            return {
+                pub: dict(counters, queued=len(self._queues[pub]))
+                for pub, counters in self._counters.items()
+            }
+
+    def _put(self, md, buffer):
+        pub = md["msg"]
+        # Server wall clock time of arrival, ns
+        md["recv_ts"] = time.time_ns()
+        with self._cond:
+            if pub not in self._queues:
+                self._queues[pub] = deque()
+                self._counters[pub] = dict(received=0, delivered=0, dropped=0)
+                self._order.append(pub)
+            queue = self._queues[pub]
+            counters = self._counters[pub]
+            counters["received"] += 1
+            if len(queue) >= self.maxlen:
+                if self.policy == "drop-newest":
+                    counters["dropped"] += 1
+                    return
+                if self.policy == "drop-oldest":
+                    queue.popleft()
+                    counters["dropped"] += 1
+                else:
+                    self._cond.wait_for(
+                        lambda: len(queue) < self.maxlen or self._stop)
+            queue.append((md, buffer))
+            self._cond.notify_all()
 
     def _run(self):
         receiver = ImageHub("tcp://{}:{}".format(self.hostnames[0], self.port), REQ_REP=False)
         for pub in self.hostnames[1:]:
             receiver.connect(f"tcp://{pub}:{self.port}")        
         while not self._stop:
-            self._data = receiver.recv_jpg()
-            self._data_ready.set()
+            self._put(*receiver.recv_frame())
         receiver.close()
 
     def close(self):
-        self._stop = True
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
 
 
+class DetectionSubscriber(VideoStreamSubscriber):
+    """ Receives the binary detection records published by the cameras """
+
+    def receive(self, timeout=15.0):
+        md, buffer = super().receive(timeout)
+        return md["msg"], unpack_detections(buffer)
 
+    def receive_batch(self, timeout=15.0):
+        return [
+            (md["msg"], unpack_detections(buffer))
+            for md, buffer in super().receive_batch(timeout)
+        ]
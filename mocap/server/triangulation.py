@@ -0,0 +1,99 @@
+"""
+Triangulation of markers matched across calibrated cameras.
+
+Every marker of a frame is solved at once: the observations are an
+(M, C, 2) array, marker m as seen by camera c, nan where the camera
+didn't see it. Projections are the (C, 3, 4) camera matrices mapping to
+the same coordinates as the observations, [R|t] for the normalized
+coordinates sent by the cameras, K [R|t] for pixels.
+"""
+from collections import namedtuple
+
+import numpy as np
+import cv2
+
+# points (M, 3), nan where there weren't enough consistent views, errors
+# (M,) mean reprojection error over the inlier views, inliers (M, C)
+Triangulation = namedtuple("Triangulation", ["points", "errors", "inliers"])
+
+
+def projection_matrix(camera_matrix, rvec, tvec):
+    """ 3x4 projection of a camera with extrinsics rvec, tvec """
+    rotation, _ = cv2.Rodrigues(np.asarray(rvec, dtype=np.float64))
+    return np.asarray(camera_matrix) @ np.hstack(
+        [rotation, np.asarray(tvec, dtype=np.float64).reshape(3, 1)])
+
+def triangulate_dlt(projections, points, views):
+    """
+    Linear (DLT) solution for every marker in one batch.
+
+    projections (C, 3, 4), points (M, C, 2), views (M, C) bool mask of
+    the observations to use. Returns (M, 3) points.
+    """
+    points = np.where(views[..., None], points, 0.0)
+    # Two equations per view, x P3 - P1 and y P3 - P2, zero for unused views
+    equations = (
+        points[..., :, None] * projections[None, :, 2:3, :] -
+        projections[None, :, :2, :]
+    ) * views[..., None, None]
+    equations = equations.reshape(len(points), -1, 4)
+    # Null vector of the equations, the eigenvector of the smallest
+    # eigenvalue of the 4x4 normal matrix is much cheaper than an SVD of
+    # the 2C x 4 system and accurate enough with normalized coordinates
+    normal = np.einsum("mki,mkj->mij", equations, equations)
+    _, vectors = np.linalg.eigh(normal)
+    homogeneous = vectors[:, :, 0]
+
+    return homogeneous[:, :3] / homogeneous[:, 3:]
+
+def reprojection_errors(projections, points_3d, points):
+    """ (M, C) distance between the observations and the reprojected points """
+    homogeneous = np.concatenate(
+        [points_3d, np.ones((len(points_3d), 1))], axis=1)
+    projected = np.einsum("cij,mj->mci", projections, homogeneous)
+    projected = projected[..., :2] / projected[..., 2:]
+
+    return np.linalg.norm(projected - points, axis=2)
+
+def triangulate(projections, points, threshold, min_views=2):
+    """
+    Triangulate all markers of a frame, rejecting outlier observations.
+
+    While the worst observation of a marker reprojects further than
+    threshold and more than min_views views are left, that observation is
+    dropped and the marker is solved again. Markers whose remaining views
+    still disagree come out as nan.
+    """
+    projections = np.asarray(projections, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64)
+    count = len(points)
+    inliers = ~np.isnan(points).any(axis=2)
+    solved = np.full((count, 3), np.nan)
+    errors = np.full((count, projections.shape[0]), np.nan)
+
+    # Markers still being refined
+    active = np.flatnonzero(inliers.sum(axis=1) >= min_views)
+    while len(active):
+        solved[active] = triangulate_dlt(
+            projections, points[active], inliers[active])
+        errors[active] = reprojection_errors(
+            projections, solved[active], points[active])
+
+        active_errors = np.where(inliers[active], errors[active], -np.inf)
+        worst = np.argmax(active_errors, axis=1)
+        outlier = (
+            (active_errors[np.arange(len(active)), worst] > threshold) &
+            (inliers[active].sum(axis=1) > min_views)
+        )
+        inliers[active[outlier], worst[outlier]] = False
+        active = active[outlier]
+
+    used = inliers.sum(axis=1)
+    errors = np.where(inliers, errors, 0.0)
+    valid = (used >= min_views) & (errors.max(axis=1, initial=0.0) <= threshold)
+    solved[~valid] = np.nan
+    inliers[~valid] = False
+    mean_errors = np.full(count, np.nan)
+    mean_errors[valid] = errors[valid].sum(axis=1) / used[valid]
+
+    return Triangulation(solved, mean_errors, inliers)
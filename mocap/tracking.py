@@ -0,0 +1,187 @@
+"""
+Marker tracking shared by the camera nodes (2D centroids) and the server
+(3D triangulated points).
+
+Every track is a constant velocity Kalman filter, the states of all tracks
+are stacked in arrays so a frame is predicted and updated in a few batched
+numpy calls whatever the number of markers.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+# ids (M,) track id of every detection, births / deaths ids of the tracks
+# started / ended on this frame
+TrackUpdate = namedtuple("TrackUpdate", ["ids", "births", "deaths"])
+
+
+def greedy_assignment(cost, gate):
+    """ (rows, cols) pairs below gate, cheapest first, each row and col once """
+    rows, cols = np.nonzero(cost <= gate)
+    order = np.argsort(cost[rows, cols], kind="stable")
+    used_rows, used_cols, pairs = set(), set(), []
+    for row, col in zip(rows[order].tolist(), cols[order].tolist()):
+        if row in used_rows or col in used_cols:
+            continue
+        used_rows.add(row)
+        used_cols.add(col)
+        pairs.append((row, col))
+    pairs = np.array(pairs, dtype=int).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+# Cost of the pairs outside the gate, far above any sum of gated costs so
+# the solver never trades a feasible pair for one of them
+INFEASIBLE = 1e9
+
+def optimal_assignment(cost, gate):
+    """ Minimum total cost pairs below gate, scipy's Hungarian solver """
+    # Pairs outside the gate only get picked when nothing else is left
+    rows, cols = linear_sum_assignment(np.where(cost <= gate, cost, INFEASIBLE))
+    inside = cost[rows, cols] <= gate
+    return rows[inside], cols[inside]
+
+
+class MarkerTracker():
+    """
+    Tracks of markers in dim (2 or 3) dimensions.
+
+    Detections are assigned to the predicted tracks by Mahalanobis
+    distance, pairs further than gate (squared, chi-square units) are
+    never assigned. The assignment is optimal when scipy is installed,
+    greedy (closest pairs first) otherwise. Unassigned detections start
+    new tracks, tracks missing max_missed frames in a row end.
+    """
+    def __init__(
+        self,
+        dim=2,
+        dt=1 / 120,
+        process_noise=1e3,
+        measurement_noise=1.0,
+        gate=16.0,
+        max_missed=5,
+        optimal=True,
+    ):
+        self.dim = dim
+        self.dt = dt
+        # Acceleration and measurement variances, units of the detections
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.gate = gate
+        self.max_missed = max_missed
+        self.assign = (
+            optimal_assignment
+            if optimal and linear_sum_assignment is not None
+            else greedy_assignment
+        )
+        # Position then velocity of every track
+        self.state = np.empty((0, 2 * dim))
+        self.covariance = np.empty((0, 2 * dim, 2 * dim))
+        self.ids = np.empty(0, dtype=np.int64)
+        self.age = np.empty(0, dtype=np.int64)
+        self.missed = np.empty(0, dtype=np.int64)
+        self.next_id = 0
+
+    def _motion(self, dt):
+        """ Transition and process noise of a constant velocity model """
+        eye = np.eye(self.dim)
+        transition = np.block([
+            [eye, dt * eye],
+            [np.zeros_like(eye), eye],
+        ])
+        noise = self.process_noise * np.block([
+            [dt**4 / 4 * eye, dt**3 / 2 * eye],
+            [dt**3 / 2 * eye, dt**2 * eye],
+        ])
+        return transition, noise
+
+    def predict(self, dt=None):
+        """ Move every track dt (default self.dt) forward """
+        transition, noise = self._motion(self.dt if dt is None else dt)
+        self.state = self.state @ transition.T
+        self.covariance = transition @ self.covariance @ transition.T + noise
+
+    def update(self, detections, dt=None):
+        """
+        Predict, assign the (M, dim) detections of the next frame and
+        update the tracks with them
+        """
+        detections = np.asarray(detections, dtype=np.float64).reshape(-1, self.dim)
+        self.predict(dt)
+        dim = self.dim
+
+        # Innovation of every track, detection pair
+        innovation_cov = (
+            self.covariance[:, :dim, :dim] +
+            self.measurement_noise * np.eye(dim)
+        )
+        inverse = np.linalg.inv(innovation_cov)
+        diff = detections[None, :, :] - self.state[:, None, :dim]
+        cost = np.einsum("tmi,tij,tmj->tm", diff, inverse, diff)
+        tracks, matched = self.assign(cost, self.gate)
+
+        # Kalman update of the assigned tracks, gain = P H^T S^-1
+        gain = self.covariance[tracks, :, :dim] @ inverse[tracks]
+        residual = diff[tracks, matched]
+        self.state[tracks] += np.einsum("tij,tj->ti", gain, residual)
+        self.covariance[tracks] -= gain @ self.covariance[tracks, :dim, :]
+        self.missed[tracks] = 0
+        self.age += 1
+
+        # Tracks with nothing assigned for too long end
+        missed = np.ones(len(self.ids), dtype=bool)
+        missed[tracks] = False
+        self.missed[missed] += 1
+        alive = self.missed <= self.max_missed
+        deaths = self.ids[~alive]
+
+        ids = np.empty(len(detections), dtype=np.int64)
+        ids[matched] = self.ids[tracks]
+        self._keep(alive)
+
+        # Every unassigned detection starts a track at rest
+        new = np.ones(len(detections), dtype=bool)
+        new[matched] = False
+        births = self._start(detections[new])
+        ids[new] = births
+
+        return TrackUpdate(ids, births, deaths)
+
+    def _keep(self, mask):
+        self.state = self.state[mask]
+        self.covariance = self.covariance[mask]
+        self.ids = self.ids[mask]
+        self.age = self.age[mask]
+        self.missed = self.missed[mask]
+
+    def _start(self, positions):
+        count = len(positions)
+        ids = np.arange(self.next_id, self.next_id + count)
+        self.next_id += count
+        state = np.concatenate([positions, np.zeros_like(positions)], axis=1)
+        # Position known to the measurement noise, velocity to what the
+        # acceleration can build up in a tenth of a second
+        variance = np.concatenate([
+            np.full(self.dim, self.measurement_noise),
+            np.full(self.dim, self.process_noise * 0.1),
+        ])
+        covariance = np.broadcast_to(np.diag(variance), (count, 2 * self.dim, 2 * self.dim))
+
+        self.state = np.concatenate([self.state, state])
+        self.covariance = np.concatenate([self.covariance, covariance])
+        self.ids = np.concatenate([self.ids, ids])
+        self.age = np.concatenate([self.age, np.zeros(count, dtype=np.int64)])
+        self.missed = np.concatenate([self.missed, np.zeros(count, dtype=np.int64)])
+        return ids
+
+    def positions(self):
+        """ Ids and positions of the tracks seen on the last frame """
+        seen = self.missed == 0
+        return self.ids[seen], self.state[seen, :self.dim]
+
+    def __len__(self):
+        return len(self.ids)
@@ -0,0 +1,38 @@
+import numpy as np
+import cv2 as cv
+
+from mocap.camera.tools import select_views, chessboard_points
+
+ROWS, COLS = 6, 9
+IMAGE_SIZE = (1920, 1200)
+CAMERA_MATRIX = np.array([[1000.0, 0, 960], [0, 1000.0, 600], [0, 0, 1]])
+
+
+def board_view(rx=0.0, ry=0.0, rz=0.0, tx=0.0, ty=0.0, z=20.0):
+    """ Corners of a board z squares in front of the camera """
+    board = chessboard_points(ROWS, COLS) - [(COLS - 1) / 2, (ROWS - 1) / 2, 0]
+    rotation, _ = cv.Rodrigues(np.array([rx, ry, rz]))
+    corners, _ = cv.projectPoints(
+        board.astype(np.float64), rotation, np.array([tx, ty, z]), CAMERA_MATRIX, None)
+    return corners.astype(np.float32)
+
+
+def test_select_views_prefers_tilt_over_duplicates():
+    rng = np.random.default_rng(0)
+    # Near duplicates of one fronto-parallel view, a few deg / px apart
+    flat = [
+        board_view(rz=rng.normal(0, 0.05), tx=rng.normal(0, 0.3), ty=rng.normal(0, 0.3))
+        for _ in range(12)
+    ]
+    tilted = [
+        board_view(rx=rx, ry=ry)
+        for rx, ry in [(0.35, 0), (-0.35, 0), (0, 0.35), (0, -0.35), (0.25, 0.25)]
+    ]
+    chosen = select_views(flat + tilted, ROWS, COLS, IMAGE_SIZE, 6)
+    # Every tilted view and one of the flat ones
+    assert np.count_nonzero(chosen >= len(flat)) == len(tilted)
+
+
+def test_select_views_keeps_all_when_few():
+    views = [board_view(tx=x) for x in range(3)]
+    assert select_views(views, ROWS, COLS, IMAGE_SIZE, 6).tolist() == [0, 1, 2]
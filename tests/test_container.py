@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from mocap.server.container import (
+    INDEX_RECORD, ContainerReader, ContainerWriter, chunk_name,
+)
+
+
+def make_frames(count, rng):
+    frames = []
+    for seq in range(count):
+        md = dict(
+            msg="cam0", seq=seq, cam_ts=1000 * seq, grab_ts=2000 * seq, recv_ts=3000 * seq,
+            codec="zstd" if seq % 3 else "raw", shape=[8, 8], dtype="uint8",
+        )
+        frames.append((md, rng.integers(0, 255, rng.integers(10, 100), dtype=np.uint8)))
+    return frames
+
+
+def record(path, frames, chunk_size=256, close=True):
+    writer = ContainerWriter(path, "cam0", chunk_size=chunk_size)
+    for i, (md, payload) in enumerate(frames):
+        writer.append(md, payload)
+        if i % 4 == 3:
+            writer.flush()
+    if close:
+        writer.close()
+    else:
+        writer.flush()
+        writer.data.close()
+        writer.index.close()
+    return writer
+
+
+def test_round_trip(tmp_path):
+    frames = make_frames(30, np.random.default_rng(0))
+    writer = record(tmp_path, frames)
+    assert writer.chunk > 0
+
+    reader = ContainerReader(tmp_path)
+    assert reader.manifest["finalized"]
+    assert reader.manifest["frames"] == len(reader) == 30
+    assert len(reader.manifest["codecs"]) == 2
+    for (md, payload), (read_md, read_payload) in zip(frames, reader.frames()):
+        assert read_md == md
+        np.testing.assert_array_equal(read_payload, payload)
+
+    with pytest.raises(FileExistsError):
+        ContainerWriter(tmp_path, "cam0")
+
+
+def test_truncated_chunk(tmp_path):
+    frames = make_frames(30, np.random.default_rng(1))
+    writer = record(tmp_path, frames, close=False)
+    # The last chunk only made it halfway to disk
+    last = tmp_path / chunk_name(writer.chunk)
+    data = last.read_bytes()
+    last.write_bytes(data[:len(data) // 2])
+
+    reader = ContainerReader(tmp_path)
+    assert not reader.manifest["finalized"]
+    assert 0 < len(reader) < 30
+    for (md, payload), (read_md, read_payload) in zip(frames, reader.frames()):
+        assert read_md == md
+        np.testing.assert_array_equal(read_payload, payload)
+    end = reader.index[-1]["offset"] + reader.index[-1]["length"]
+    assert reader.index[-1]["chunk"] < writer.chunk or end <= len(data) // 2
+
+
+def test_torn_index_record(tmp_path):
+    frames = make_frames(12, np.random.default_rng(2))
+    record(tmp_path, frames, close=False)
+    with open(tmp_path / "index.bin", "ab") as f:
+        f.write(b"\x01" * (INDEX_RECORD.itemsize // 2))
+
+    reader = ContainerReader(tmp_path)
+    assert len(reader) == 12
+    md, payload = reader.read(11)
+    assert md == frames[11][0]
+    np.testing.assert_array_equal(payload, frames[11][1])
+
+
+def test_empty_unfinalized(tmp_path):
+    ContainerWriter(tmp_path, "cam0")
+    assert len(ContainerReader(tmp_path)) == 0
@@ -0,0 +1,44 @@
+import numpy as np
+
+from mocap.server.benchmark import FOCAL, make_cameras, make_observations
+from mocap.server.correspondence import EpipolarMatcher
+
+
+def make_views(projections, num_markers, rng):
+    points = make_observations(
+        projections, rng.uniform(-1, 1, (num_markers, 3)), 0.5, 0, 0.2, rng)
+    views, ids = [], []
+    for cam in range(len(projections)):
+        seen = rng.permutation(np.flatnonzero(~np.isnan(points[:, cam, 0])))
+        views.append(points[seen, cam])
+        ids.append(seen)
+    return views, ids
+
+
+def test_support_counts_triangles():
+    rng = np.random.default_rng(0)
+    num_nodes = 40
+    pairs = {tuple(sorted(pair)) for pair in rng.integers(0, num_nodes, (300, 2))}
+    first, second = np.array([pair for pair in pairs if pair[0] != pair[1]]).T
+    adjacency = np.zeros((num_nodes, num_nodes), dtype=int)
+    adjacency[first, second] = adjacency[second, first] = 1
+    expected = (adjacency @ adjacency)[first, second]
+
+    matcher = EpipolarMatcher(make_cameras(3), 1.0 / FOCAL)
+    np.testing.assert_array_equal(matcher.support(num_nodes, first, second), expected)
+
+
+def test_groups_one_marker_per_camera():
+    rng = np.random.default_rng(1)
+    projections = make_cameras(8)
+    matcher = EpipolarMatcher(projections, 2.0 / FOCAL)
+    pure = total = 0
+    for _ in range(5):
+        views, ids = make_views(projections, 60, rng)
+        matches = matcher.match(views)
+        assert matches.points.shape == (len(matches.index), 8, 2)
+        assert np.all((matches.index >= 0).sum(axis=1) >= 2)
+        for row in matches.index:
+            pure += len({ids[cam][i] for cam, i in enumerate(row) if i >= 0}) == 1
+        total += len(matches.index)
+    assert pure / total > 0.97
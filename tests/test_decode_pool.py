@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from mocap.codecs import CODECS, create_codec, decode_frame
+from mocap.server.decode_pool import DecodePool
+
+
+def make_frames(count, rng):
+    frames = []
+    for _ in range(count):
+        image = np.zeros((480, 640), dtype=np.uint8)
+        x, y = rng.integers(0, 600), rng.integers(0, 440)
+        image[y:y + 40, x:x + 40] = rng.integers(100, 255, (40, 40))
+        frames.append(image)
+    return frames
+
+
+@pytest.mark.parametrize("name", ["zstd", "lz4"])
+def test_decode_from_threads(name):
+    if name not in CODECS:
+        pytest.skip(f"{name} is not installed")
+    rng = np.random.default_rng(0)
+    frames = make_frames(32, rng)
+    codec = create_codec(name)
+    messages = []
+    for image in frames:
+        payload, meta = codec.encode(image)
+        messages.append((dict(meta, codec=name), payload))
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        decoded = list(pool.map(
+            lambda message: decode_frame(*message), messages * 16))
+    for i, image in enumerate(decoded):
+        np.testing.assert_array_equal(image, frames[i % len(frames)])
+
+
+@pytest.mark.parametrize("name", ["zstd", "lz4"])
+def test_decode_pool_order(name):
+    if name not in CODECS:
+        pytest.skip(f"{name} is not installed")
+    rng = np.random.default_rng(1)
+    frames = make_frames(16, rng)
+    codec = create_codec(name)
+
+    pool = DecodePool(workers=4)
+    for i, image in enumerate(frames * 4):
+        payload, meta = codec.encode(image)
+        pool.submit(dict(meta, codec=name, msg=f"cam{i % 3}", seq=i), payload)
+    decoded = pool.drain()
+    pool.close()
+
+    assert len(decoded) == 64
+    for md, image in decoded:
+        np.testing.assert_array_equal(image, frames[md["seq"] % len(frames)])
+    for cam in range(3):
+        seqs = [md["seq"] for md, _ in decoded if md["msg"] == f"cam{cam}"]
+        assert seqs == sorted(seqs)
@@ -0,0 +1,62 @@
+import numpy as np
+
+from mocap.camera.frame_ring import FrameRing
+from mocap.camera.detect_pool import ReorderBuffer
+
+
+def publish(ring, count):
+    for _ in range(count):
+        ring.publish(np.full((4, 4), ring.head + 1, dtype=np.uint8))
+
+
+def test_overrun_resumes_at_oldest():
+    ring = FrameRing(4, 4, num_slots=8)
+    reader = ring.reader()
+    publish(ring, 20)
+    frame = reader.poll()
+    # Slot of head + 1 may be in the middle of a write, 7 frames are valid
+    assert frame.seq == 14
+    assert reader.dropped == 13
+    assert [reader.poll().seq for _ in range(6)] == [15, 16, 17, 18, 19, 20]
+
+
+def test_overrun_catch_up_to_newest():
+    ring = FrameRing(4, 4, num_slots=8)
+    reader = ring.reader(catch_up=True)
+    publish(ring, 20)
+    assert reader.poll().seq == 20
+    assert reader.dropped == 19
+    assert reader.poll() is None
+
+
+def test_catch_up_with_large_stride():
+    ring = FrameRing(4, 4, num_slots=4)
+    readers = [ring.reader(stride=4, offset=k, catch_up=True) for k in range(4)]
+    publish(ring, 22)
+    frames = [reader.poll() for reader in readers]
+    assert [frame.seq for frame in frames[:3]] == [20, 21, 22]
+    # Frame 19 is overwritten already, wait for 23 instead of going below
+    # the oldest frame
+    assert frames[3] is None
+    assert readers[3].poll() is None
+    assert readers[3].dropped == 5
+    publish(ring, 1)
+    assert readers[3].poll().seq == 23
+    assert readers[3].dropped == 5
+
+
+def test_reorder_seeded_from_first_seq():
+    buffer = ReorderBuffer(depth=4, first_seq=10)
+    assert buffer.push(11, "b") == []
+    assert buffer.push(10, "a") == ["a", "b"]
+    assert buffer.dropped == 0
+
+
+def test_reorder_skips():
+    buffer = ReorderBuffer(depth=2, first_seq=0)
+    assert buffer.push(2, "c") == []
+    assert buffer.skip([0, 1]) == ["c"]
+    assert buffer.skip([3]) == []
+    assert buffer.push(5, "f") == []
+    assert buffer.push(4, "e") == ["e", "f"]
+    assert (buffer.processed, buffer.skipped, buffer.dropped) == (3, 3, 0)
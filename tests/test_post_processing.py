@@ -0,0 +1,72 @@
+from pathlib import Path
+
+import numpy as np
+import cv2 as cv
+import yaml
+
+from mocap.camera.tools import detect_marker
+from mocap.camera.post_processing import WindowedDetector
+
+
+CONFIG = Path(__file__).resolve().parent.parent / "configs" / "synthetic_cam.yaml"
+
+
+def load_config():
+    with open(CONFIG) as f:
+        return yaml.safe_load(f)["POST_PROC"]
+
+
+def draw(markers, shape=(600, 800), blobs=()):
+    img = np.zeros(shape, dtype=np.uint8)
+    for x, y in markers:
+        cv.circle(img, (int(x), int(y)), 10, 255, -1)
+    for x, y in blobs:
+        # Bright, but not round enough for a marker
+        cv.rectangle(img, (int(x), int(y)), (int(x) + 60, int(y) + 6), 255, -1)
+    return img
+
+
+def test_windowed_picks_up_new_markers():
+    config = dict(load_config(), TRACK_FULL_EVERY=30)
+    detector = WindowedDetector(config)
+    tracked = np.array([(150.0, 100.0), (400.0, 250.0), (650.0, 150.0)])
+    for frame in range(60):
+        positions = tracked + (frame % 10, frame % 7)
+        # A marker enters the view every 10 frames, between full scans
+        entering = [(150 + 100 * k, 450) for k in range(frame // 10)]
+        img = draw(np.concatenate([positions, np.reshape(entering, (-1, 2))]))
+        found = detector(img)
+        expected = detect_marker(img, config)
+        assert len(found) == len(expected), f"frame {frame}"
+        np.testing.assert_allclose(
+            np.sort(found["x"]), np.sort(expected["x"]), atol=1e-6)
+    assert detector.window_scans > 30
+
+
+def test_windowed_picks_up_markers_entering_across_the_edge():
+    config = dict(load_config(), TRACK_FULL_EVERY=30)
+    detector = WindowedDetector(config)
+    tracked = [(400.0, 300.0)]
+    for frame in range(40):
+        # Bright from the first frame, only a marker once it is BALL_SIZE
+        # away from the edge
+        entering = (-10 + 3 * frame, 200)
+        img = draw(tracked + [entering])
+        found = detector(img)
+        expected = detect_marker(img, config)
+        assert len(found) == len(expected), f"frame {frame}"
+        np.testing.assert_allclose(
+            np.sort(found["x"]), np.sort(expected["x"]), atol=1e-6)
+    assert len(found) == 2
+    assert detector.full_scans == 2
+
+
+def test_windowed_ignores_blobs_that_are_not_markers():
+    config = dict(load_config(), TRACK_FULL_EVERY=30)
+    detector = WindowedDetector(config)
+    for frame in range(30):
+        img = draw([(200 + frame, 200)], blobs=[(500, 400)])
+        assert len(detector(img)) == 1
+    # The blob that isn't a marker doesn't force a full scan every frame
+    assert detector.full_scans == 1
+    assert detector.blob_scans == 29
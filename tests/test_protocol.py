@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from mocap.protocol import (
+    DETECTION_HEADER, MARKER_RECORD, MARKER_RECORD_NORMALIZED,
+    pack_detections, unpack_detections,
+)
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+
+def make_markers(count, dtype, rng):
+    markers = np.zeros(count, dtype=dtype)
+    for name in dtype.names:
+        markers[name] = rng.uniform(-1, 1000, count)
+    return markers
+
+
+@pytest.mark.parametrize("dtype", [MARKER_RECORD, MARKER_RECORD_NORMALIZED])
+@pytest.mark.parametrize("count", [0, 1, 17])
+def test_round_trip(dtype, count):
+    markers = make_markers(count, dtype, np.random.default_rng(count))
+    buffer = pack_detections(2**63 + 5, -7, 1_700_000_000_123_456_789, markers)
+    assert len(buffer) == DETECTION_HEADER.size + count * dtype.itemsize
+
+    record = unpack_detections(buffer)
+    assert (record.seq, record.cam_ts, record.grab_ts) == (
+        2**63 + 5, -7, 1_700_000_000_123_456_789)
+    assert record.markers.dtype == dtype
+    np.testing.assert_array_equal(record.markers, markers)
+
+
+def test_extra_fields_dropped():
+    dtype = np.dtype(MARKER_RECORD_NORMALIZED.descr + [("area", "<i4")])
+    markers = make_markers(3, dtype, np.random.default_rng(0))
+    record = unpack_detections(pack_detections(1, 2, 3, markers))
+    assert record.markers.dtype == MARKER_RECORD_NORMALIZED
+    for name in MARKER_RECORD_NORMALIZED.names:
+        np.testing.assert_array_equal(record.markers[name], markers[name])
+
+
+@pytest.mark.skipif(zmq is None, reason="pyzmq is not installed")
+@pytest.mark.parametrize("count", [0, 5])
+def test_unpack_zmq_frame(count):
+    markers = make_markers(count, MARKER_RECORD_NORMALIZED, np.random.default_rng(1))
+    context = zmq.Context()
+    sender, receiver = context.socket(zmq.PAIR), context.socket(zmq.PAIR)
+    try:
+        receiver.bind("inproc://detections")
+        sender.connect("inproc://detections")
+        sender.send(pack_detections(42, 1, 2, markers), copy=False)
+        frame = receiver.recv(copy=False)
+        assert isinstance(frame, zmq.Frame)
+        record = unpack_detections(frame)
+    finally:
+        sender.close(linger=0)
+        receiver.close(linger=0)
+        context.term()
+    assert record.seq == 42
+    np.testing.assert_array_equal(record.markers, markers)
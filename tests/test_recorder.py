@@ -0,0 +1,58 @@
+import json
+import threading
+import time
+
+import numpy as np
+
+from mocap.server.recorder import Recorder
+
+
+def frames(count):
+    for i in range(count):
+        md = dict(msg="cam0", codec="raw", shape=(4, 4), seq=i, recv_ts=i)
+        yield md, np.full((4, 4), i, dtype=np.uint8).tobytes()
+
+
+def test_records_files(tmp_path):
+    recorder = Recorder(tmp_path, batch=4)
+    for md, buffer in frames(10):
+        assert recorder.record(md, buffer)
+    recorder.close()
+
+    lines = (tmp_path / "cam0" / "frames.jsonl").read_text().splitlines()
+    assert [json.loads(line)["seq"] for line in lines] == list(range(10))
+    assert (tmp_path / "cam0" / "frame_3.bin").read_bytes() == bytes([3] * 16)
+    assert recorder.stats()["written"] == 10
+
+
+def test_failing_sink(tmp_path):
+    # A file where the recording dir should be
+    data_dir = tmp_path / "not_a_dir"
+    data_dir.write_text("")
+    recorder = Recorder(data_dir, max_queue=4, batch=2)
+    for md, buffer in frames(50):
+        recorder.record(md, buffer)
+        time.sleep(0.001)
+
+    start = time.monotonic()
+    recorder.close(timeout=1.0)
+    assert time.monotonic() - start < 1.0
+    stats = recorder.stats()
+    assert stats["written"] == 0
+    assert stats["errors"] > 0
+    assert stats["failed"] + stats["dropped"] == 50
+    assert "NotADirectoryError" in stats["last_error"]
+
+
+def test_close_does_not_hang_on_a_stuck_sink(tmp_path):
+    recorder = Recorder(tmp_path, max_queue=2, batch=1)
+    release = threading.Event()
+    recorder._write = lambda batch: release.wait()
+    for md, buffer in frames(10):
+        recorder.record(md, buffer)
+
+    start = time.monotonic()
+    recorder.close(timeout=0.2)
+    assert time.monotonic() - start < 1.0
+    assert recorder.stats()["dropped"] > 0
+    release.set()
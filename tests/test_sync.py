@@ -0,0 +1,73 @@
+from mocap.server.sync import FrameSynchronizer
+
+MS = 1_000_000
+CAMERAS = ["cam0", "cam1", "cam2"]
+
+
+def push_all(sync, timestamp, now, cameras=CAMERAS):
+    sets = []
+    for camera in cameras:
+        sets += sync.push(camera, timestamp, (camera, timestamp), now=now)
+    return sets
+
+
+def test_dropped_frame_released_by_next_set():
+    sync = FrameSynchronizer(CAMERAS, tolerance=2 * MS, deadline=50 * MS)
+    assert len(push_all(sync, 0, now=0)) == 1
+    # cam2 drops the frame at 10 ms
+    assert push_all(sync, 10 * MS, now=10 * MS, cameras=CAMERAS[:2]) == []
+    sets = push_all(sync, 20 * MS, now=20 * MS)
+
+    assert [frame_set.timestamp for frame_set in sets] == [10 * MS, 20 * MS]
+    assert not sets[0].complete and sorted(sets[0].items) == CAMERAS[:2]
+    assert sets[1].complete
+    stats = sync.stats()
+    assert (stats["complete"], stats["incomplete"], stats["pending"]) == (2, 1, 0)
+    assert stats["missing"] == dict(cam0=0, cam1=0, cam2=1)
+    assert stats["late"] == dict.fromkeys(CAMERAS, 0)
+
+
+def test_dropped_frame_released_at_deadline():
+    sync = FrameSynchronizer(CAMERAS, tolerance=2 * MS, deadline=50 * MS)
+    assert push_all(sync, 0, now=0, cameras=CAMERAS[1:]) == []
+    assert sync.poll(now=50 * MS - 1) == []
+    sets = sync.poll(now=50 * MS)
+    assert len(sets) == 1 and not sets[0].complete
+    assert sync.stats()["missing"]["cam0"] == 1
+
+
+def test_tolerance_boundary():
+    sync = FrameSynchronizer(CAMERAS, tolerance=2 * MS, deadline=50 * MS)
+    # Exactly tolerance apart joins the set, one ns more starts a new one
+    sync.push("cam0", 100 * MS, "a", now=0)
+    sync.push("cam1", 102 * MS, "b", now=0)
+    sync.push("cam2", 98 * MS - 1, "c", now=0)
+    assert [sorted(pending.items) for pending in sync.pending] == [
+        ["cam2"], ["cam0", "cam1"]]
+
+    # Skips the set holding a frame of its camera already
+    sets = sync.push("cam2", 101 * MS, "d", now=0)
+    assert len(sets) == 2
+    assert not sets[0].complete and sets[0].timestamp == 98 * MS - 1
+    assert sets[1].complete and sets[1].items["cam2"] == "d"
+
+
+def test_late_frames():
+    sync = FrameSynchronizer(CAMERAS, tolerance=2 * MS, deadline=50 * MS)
+    push_all(sync, 100 * MS, now=0)
+    # Within tolerance of the emitted set, its set is gone
+    assert sync.push("cam0", 102 * MS, "late", now=0) == []
+    assert sync.pending == []
+    # Just past it starts a new set
+    sync.push("cam0", 102 * MS + 1, "next", now=0)
+    assert len(sync.pending) == 1
+    stats = sync.stats()
+    assert stats["late"] == dict(cam0=1, cam1=0, cam2=0)
+    assert stats["received"]["cam0"] == 3
+
+
+def test_unknown_camera():
+    sync = FrameSynchronizer(CAMERAS, tolerance=2 * MS, deadline=50 * MS)
+    assert sync.push("cam9", 0, "x", now=0) == []
+    assert sync.stats()["unknown"] == 1
+    assert sync.pending == []
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from mocap.tracking import greedy_assignment, optimal_assignment, linear_sum_assignment
+
+
+@pytest.mark.skipif(linear_sum_assignment is None, reason="scipy is not installed")
+def test_optimal_keeps_feasible_pairs():
+    # Track 0 is gated out for detection 2 but feasible for detection 0.
+    # With a small filler cost for the gated pair, shifting tracks 1 and 2
+    # onto the cheap (1, 0), (2, 1) pairs and giving track 0 the filler
+    # beats the three feasible pairs, dropping a valid match.
+    gate = 16.0
+    cost = np.array([
+        [15.0, 1e3, 1e3],
+        [0.0, 15.0, 1e3],
+        [1e3, 0.0, 15.0],
+    ])
+    rows, cols = optimal_assignment(cost, gate)
+    assert sorted(zip(rows.tolist(), cols.tolist())) == [(0, 0), (1, 1), (2, 2)]
+
+
+def test_greedy_respects_gate():
+    cost = np.array([
+        [1.0, 20.0],
+        [2.0, 30.0],
+    ])
+    rows, cols = greedy_assignment(cost, 16.0)
+    assert list(zip(rows.tolist(), cols.tolist())) == [(0, 0)]